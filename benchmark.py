@@ -0,0 +1,397 @@
+"""Benchmarks for the KPI pipeline in server.py, run against synthetic companyfacts payloads.
+
+    python benchmark.py periods --years 30
+    python benchmark.py quarters --years 300
+    python benchmark.py parse --concepts 2000
+    python benchmark.py stages --years 30 --duplicates 2 --missing-quarters 0.1
+    python benchmark.py routes --requests 200
+
+stages and routes compare their timings with the baseline stored in benchmark_baseline.json
+for the same benchmark and payload settings, and exit with status 1 if one regressed by more
+than --tolerance. --save-baseline stores the timings of the run as the new baseline.
+
+No baseline is committed, timings depend on the machine: run once with --save-baseline on the
+machine the comparisons will run on, with the settings they will use, before comparing.
+"""
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+import server
+
+
+BASELINE_FILE = "benchmark_baseline.json"
+# Generated histories end with this fiscal year whatever the date, so payloads and their baselines stay put
+LAST_FISCAL_YEAR = 2025
+
+
+def generate_records(rnd, cik, fiscal_years, unit, duplicates=1, missing_quarters=0.0):
+    """Facts of one concept: a 10-K per fiscal year and 10-Qs with three-month and year-to-date values
+    for Q1-Q3, each figure repeated as a comparative by the next duplicates years' filings.
+
+    Each 10-Q is left out with probability missing_quarters, as when a filer's quarterly data is
+    missing, which leaves fiscal years with fewer than three known quarters."""
+    records = []
+    scale = 10 ** rnd.randint(6, 11) if unit in ("USD", "shares") else 1
+    for index, (year, fy_start, fy_end, quarters) in enumerate(fiscal_years):
+        values = [rnd.randint(scale, 2 * scale) if scale > 1 else round(rnd.uniform(0.1, 3), 2) for _ in quarters]
+        filings = range(1 + min(duplicates, len(fiscal_years) - 1 - index))
+        for filing in filings:
+            filed = fy_end + timedelta(days=40 + 365 * filing)
+            records.append({
+                'start': fy_start.isoformat(), 'end': fy_end.isoformat(), 'val': sum(values),
+                'accn': f"{cik:010d}-{filed.year % 100:02d}-{index * 10 + filing:06d}",
+                'fy': year + filing, 'fp': 'FY', 'form': '10-K', 'filed': filed.isoformat()
+            })
+        for quarter, (start, end) in enumerate(quarters[:3]):
+            if missing_quarters and rnd.random() < missing_quarters:
+                continue
+            for filing in filings:
+                filed = end + timedelta(days=35 + 365 * filing)
+                accn = f"{cik:010d}-{filed.year % 100:02d}-{index * 10 + 4 + quarter * 2 + filing:06d}"
+                fp = f"Q{quarter + 1}"
+                records.append({
+                    'start': start.isoformat(), 'end': end.isoformat(), 'val': values[quarter], 'accn': accn,
+                    'fy': year + filing, 'fp': fp, 'form': '10-Q', 'filed': filed.isoformat()
+                })
+                if quarter:
+                    records.append({
+                        'start': fy_start.isoformat(), 'end': end.isoformat(), 'val': sum(values[:quarter + 1]),
+                        'accn': accn, 'fy': year + filing, 'fp': fp, 'form': '10-Q', 'filed': filed.isoformat()
+                    })
+    records.sort(key=lambda record: (record['end'], record['filed']))
+    return records
+
+
+def generate_companyfacts(cik=320193, years=20, fiscal_year_end_month=9, extra_concepts=0, seed=0,
+                          duplicates=1, missing_quarters=0.0):
+    """Build a deterministic companyfacts payload shaped like the SEC's.
+
+    It covers every us-gaap concept in LABELS_SETS, plus extra_concepts filler concepts that the
+    pipeline never reads, like the thousands of other concepts a real filer reports.
+    duplicates and missing_quarters are passed on to generate_records."""
+    rnd = random.Random(seed)
+    first_year = LAST_FISCAL_YEAR + 1 - years
+    fiscal_years = []
+    for year in range(first_year, first_year + years):
+        fy_end = datetime.date(year, fiscal_year_end_month, 28)
+        fy_start = fy_end - timedelta(days=364)
+        quarter_starts = [fy_start + timedelta(days=91 * quarter) for quarter in range(4)]
+        quarter_ends = [start - timedelta(days=1) for start in quarter_starts[1:]] + [fy_end]
+        fiscal_years.append((year, fy_start, fy_end, list(zip(quarter_starts, quarter_ends))))
+
+    concepts = {}
+    for labels, unit in server.LABELS_SETS.values():
+        for name in labels:
+            namespace, concept = server.split_concept(name)
+            if namespace == 'us-gaap':
+                concepts.setdefault(concept, unit)
+    for index in range(extra_concepts):
+        concepts[f"SyntheticConcept{index:05d}"] = "USD"
+
+    us_gaap = {}
+    for concept, unit in concepts.items():
+        us_gaap[concept] = {
+            'label': concept,
+            'description': f"Synthetic description of {concept}, long enough to weigh like the real ones.",
+            'units': {unit: generate_records(rnd, cik, fiscal_years, unit, duplicates, missing_quarters)}
+        }
+    dei = {'EntityCommonStockSharesOutstanding': {'label': 'Entity Common Stock, Shares Outstanding', 'units': {
+        'shares': [{'end': fy_end.isoformat(), 'val': rnd.randint(10 ** 6, 10 ** 9), 'accn': f"{cik:010d}-{year}",
+                    'fy': year, 'fp': 'FY', 'form': '10-K', 'filed': fy_end.isoformat()}
+                   for year, fy_start, fy_end, quarters in fiscal_years]}}}
+
+    return {'cik': cik, 'entityName': f"Synthetic Company {cik}", 'facts': {'dei': dei, 'us-gaap': us_gaap}}
+
+
+def day_by_day_fiscal_year(start_date, end_date):
+    """Reference implementation: count the days of each year one day at a time."""
+    days_in_year = {}
+    current_date = start_date
+    while current_date <= end_date:
+        days_in_year[current_date.year] = days_in_year.get(current_date.year, 0) + 1
+        current_date += timedelta(days=1)
+    return max(days_in_year, key=days_in_year.get)
+
+
+def day_by_day_quarter(start_date, end_date):
+    """Reference implementation: count the days of each quarter one day at a time."""
+    days_in_quarter = {}
+    current_date = start_date
+    while current_date <= end_date:
+        quarter = f"Q{(current_date.month - 1) // 3 + 1}"
+        days_in_quarter[quarter] = days_in_quarter.get(quarter, 0) + 1
+        current_date += timedelta(days=1)
+    return max(days_in_quarter, key=days_in_quarter.get)
+
+
+def timed(function, calls):
+    """Call function once per tuple of arguments, returning the elapsed seconds and the results.
+
+    Like timeit, garbage collection is paused so collections triggered by the large payloads
+    held by the benchmark don't land at random in the timings."""
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        results = [function(*args) for args in calls]
+        return time.perf_counter() - started, results
+    finally:
+        gc.enable()
+
+
+def bench_periods(data):
+    """Time fiscal year and quarter assignment over every period of a payload against the day-by-day loops."""
+    periods = []
+    for labels, unit in server.LABELS_SETS.values():
+        for record in server.extract_and_sum_data_from_labels(data, labels, unit):
+            if 'start' in record:
+                periods.append((server.parse_date(record['start']), server.parse_date(record['end'])))
+    print(f"{len(periods)} periods")
+
+    for name, reference, function in [("fiscal year", day_by_day_fiscal_year, server.get_fiscal_year_from_dates),
+                                      ("quarter", day_by_day_quarter, server.get_quarter_from_dates)]:
+        function.cache_clear()
+        reference_time, expected = timed(reference, periods)
+        cold_time, results = timed(function, periods)
+        warm_time, _ = timed(function, periods)
+        assert results == expected, f"{name} assignment differs from the day-by-day reference"
+        print(f"{name:12} day-by-day {reference_time * 1000:9.2f} ms   closed-form {cold_time * 1000:7.2f} ms "
+              f"({reference_time / cold_time:5.1f}x)   memoized {warm_time * 1000:6.2f} ms ({reference_time / warm_time:5.1f}x)")
+
+
+def scan_missing_quarter_data(revenues):
+    """Reference implementation: rescan every quarter for each fiscal year."""
+    full_years = [r for r in revenues if r.fp == 'FY']
+    quarters = [r for r in revenues if 'Q' in r.fp]
+    for fy in full_years:
+        fy_quarters = sorted((q for q in quarters if q.start >= fy.start and q.end <= fy.end), key=lambda q: q.start)
+        if len(fy_quarters) != 3:
+            continue
+        prev_end = fy.start
+        for q in fy_quarters:
+            if q.start != prev_end:
+                missing_start, missing_end = prev_end, q.start - 1
+                break
+            prev_end = q.end + 1
+        else:
+            missing_start, missing_end = prev_end, fy.end
+        missing_value = fy.val - sum(q.val for q in fy_quarters)
+        revenues.append(server.Fact(missing_start, missing_end, missing_value, fy.accn, fy.fy, 'QX', fy.form, fy.filed))
+    return revenues
+
+
+def bench_quarters(data):
+    """Time missing-quarter inference over every label set against the per-fiscal-year rescan, checking both agree."""
+    deduplicated_data = []
+    for labels, unit in server.LABELS_SETS.values():
+        facts = server.parse_facts(server.extract_and_sum_data_from_labels(data, labels, unit))
+        deduplicated_data.append(server.deduplicate_data(facts))
+    print(f"{sum(len(facts) for facts in deduplicated_data)} deduplicated facts")
+
+    calls = [(facts,) for facts in deduplicated_data]
+    reference_time, expected = timed(lambda facts: scan_missing_quarter_data(list(facts)), calls)
+    merge_time, results = timed(lambda facts: server.add_missing_quarter_data(list(facts)), calls)
+
+    def as_tuples(results):
+        return [[(fact.start, fact.end, fact.val, fact.fp) for fact in facts] for facts in results]
+    assert as_tuples(results) == as_tuples(expected), "missing quarters differ from the rescanning reference"
+    print(f"missing quarters  rescan {reference_time * 1000:9.2f} ms   sort-merge {merge_time * 1000:7.2f} ms "
+          f"({reference_time / merge_time:5.1f}x)")
+
+
+def bench_parse(data):
+    """Compare parse time and peak memory of json.loads and the selective parse_companyfacts."""
+    text = json.dumps(data)
+    print(f"{len(text) / 2 ** 20:.1f} MB document, {len(data['facts']['us-gaap'])} us-gaap concepts")
+
+    results = {}
+    for name, parse in [("json.loads", json.loads), ("selective", server.parse_companyfacts)]:
+        elapsed, _ = timed(parse, [(text,)])
+        # Tracing allocations slows parsing down, so memory is measured on a separate run
+        tracemalloc.start()
+        results[name] = parse(text)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:10} {elapsed * 1000:8.1f} ms   peak {peak / 2 ** 20:7.1f} MB")
+
+    for labels, unit in server.LABELS_SETS.values():
+        assert (server.extract_and_sum_data_from_labels(results["selective"], labels, unit) ==
+                server.extract_and_sum_data_from_labels(results["json.loads"], labels, unit))
+
+
+def best_time(function, make_calls, repeat):
+    """The best elapsed time of repeat timed() runs, with fresh arguments from make_calls for each."""
+    return min(timed(function, make_calls())[0] for _ in range(repeat))
+
+
+def bench_stages(data, repeat=5):
+    """Time each stage of the pipeline process_data runs, over every label set, returning seconds by stage."""
+    text = json.dumps(data)
+    labels_sets = list(server.LABELS_SETS.values())
+    parsed = server.parse_companyfacts(text)
+    extracted = [server.parse_facts(server.extract_and_sum_data_from_labels(parsed, labels, unit))
+                 for labels, unit in labels_sets]
+    deduplicated = [server.deduplicate_data(facts) for facts in extracted]
+    completed = [server.add_missing_quarter_data(list(facts)) for facts in deduplicated]
+    print(f"{len(text) / 2 ** 20:.1f} MB document, {sum(map(len, extracted))} extracted facts, "
+          f"{sum(map(len, deduplicated))} deduplicated, {sum(map(len, completed)) - sum(map(len, deduplicated))} missing quarters")
+
+    with tempfile.TemporaryDirectory() as directory:
+        local_path = os.path.join(directory, "benchmark.facts")
+        server.cache_fact_columns(local_path, parsed)
+        columns = server.FactColumns(local_path)
+        results = {
+            "load json": best_time(server.parse_companyfacts, lambda: [(text,)], repeat),
+            "load cache": best_time(server.FactColumns, lambda: [(local_path,)], repeat),
+            "extract_and_sum_data_from_labels": best_time(
+                lambda labels, unit: server.parse_facts(server.extract_and_sum_data_from_labels(parsed, labels, unit)),
+                lambda: labels_sets, repeat),
+            "extraction plan from cache": best_time(server.EXTRACTION_PLAN.extract, lambda: [(columns,)], repeat),
+            "deduplicate_data": best_time(server.deduplicate_data, lambda: [(facts,) for facts in extracted], repeat),
+            "add_missing_quarter_data": best_time(server.add_missing_quarter_data,
+                                                  lambda: [(list(facts),) for facts in deduplicated], repeat),
+            "format_data": best_time(server.format_data, lambda: [(facts,) for facts in completed], repeat),
+        }
+    for name, elapsed in results.items():
+        print(f"{name:34} {elapsed * 1000:9.2f} ms")
+    return results
+
+
+def bench_routes(data, requests=100, repeat=5):
+    """Time the Flask routes through the test client against a temporary cache holding the payload.
+
+    Each route is timed cold, with the processed cache cleared before every request, and warm,
+    as the mean over requests repeated requests. Returns seconds per request by route."""
+    routes = [
+        "/process_annual?ticker=SYN",
+        "/process_quarterly?ticker=SYN",
+        "/kpis?ticker=SYN&labels=Revenues,NetIncome&period=quarterly",
+        "/kpis?ticker=SYN&from=2015-01-01&to=2018-12-31",
+        "/kpis?ticker=SYN&metrics=GrossMargin,RevenueGrowthYoY,RevenueTTM,SplitAdjustedEPS",
+        "/process_batch?tickers=SYN",
+    ]
+    settings = {name: getattr(server, name) for name in
+                ("CACHE_DIR", "PROCESSED_CACHE_DIR", "SERIES_CACHE_DIR", "TICKER_MAPPING_FILE")}
+    directory = tempfile.mkdtemp()
+    try:
+        server.CACHE_DIR = os.path.join(directory, "cache")
+        server.PROCESSED_CACHE_DIR = os.path.join(server.CACHE_DIR, "processed")
+        server.SERIES_CACHE_DIR = os.path.join(server.CACHE_DIR, "series")
+        server.TICKER_MAPPING_FILE = os.path.join(directory, "ticker_cik_mapping.json")
+        with open(server.TICKER_MAPPING_FILE, "w") as file:
+            json.dump({"0": {"cik_str": data['cik'], "ticker": "SYN", "title": data['entityName']}}, file)
+        cik = f"{data['cik']:010d}"
+        server.cache_fact_columns(server.cache_path(cik), server.parse_companyfacts(json.dumps(data)),
+                                  soft_ttl=10 ** 9, hard_ttl=10 ** 9)
+
+        def clear_processed_cache():
+            server._processed_cache.clear()
+            server._response_cache.clear()
+            server._as_of_indexes.clear()
+            shutil.rmtree(server.PROCESSED_CACHE_DIR, ignore_errors=True)
+            shutil.rmtree(server.SERIES_CACHE_DIR, ignore_errors=True)
+
+        client = server.app.test_client()
+        results = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for route in routes:
+                cold = []
+                for _ in range(repeat):
+                    clear_processed_cache()
+                    started = time.perf_counter()
+                    response = client.get(route)
+                    response.get_data()
+                    cold.append(time.perf_counter() - started)
+                    assert response.status_code == 200 and b'"error"' not in response.data, f"{route} failed"
+                started = time.perf_counter()
+                for _ in range(requests):
+                    client.get(route).get_data()
+                results[f"{route} cold"] = min(cold)
+                results[f"{route} warm"] = (time.perf_counter() - started) / requests
+    finally:
+        for name, value in settings.items():
+            setattr(server, name, value)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for route in routes:
+        cold, warm = results[f"{route} cold"], results[f"{route} warm"]
+        print(f"{route:84} cold {cold * 1000:8.2f} ms   warm {warm * 1000:7.2f} ms ({1 / warm:7.0f} requests/s)")
+    return results
+
+
+def baseline_key(args):
+    """Timings are only comparable for the same benchmark over the same payload."""
+    return (f"{args.benchmark} years={args.years} concepts={args.concepts} seed={args.seed} "
+            f"duplicates={args.duplicates} missing-quarters={args.missing_quarters}")
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Print how each timing compares with its baseline, returning the names of those slower by more than tolerance."""
+    regressions = []
+    for name, elapsed in results.items():
+        if name not in baseline:
+            continue
+        change = elapsed / baseline[name] - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{'REGRESSION' if regressed else 'ok':10} {name:84} {change:+7.1%} vs {baseline[name] * 1000:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=["periods", "quarters", "parse", "stages", "routes"])
+    parser.add_argument("--years", type=int, default=30, help="years of filing history to generate")
+    parser.add_argument("--concepts", type=int, default=0, help="filler concepts to add to the payload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duplicates", type=int, default=1, help="later years' filings repeating each figure")
+    parser.add_argument("--missing-quarters", type=float, default=0.0, help="share of 10-Q figures left out")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route for warm timings")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="file holding the stored baselines")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run's timings as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    data = generate_companyfacts(years=args.years, extra_concepts=args.concepts, seed=args.seed,
+                                 duplicates=args.duplicates, missing_quarters=args.missing_quarters)
+    if args.benchmark == "periods":
+        bench_periods(data)
+    elif args.benchmark == "quarters":
+        bench_quarters(data)
+    elif args.benchmark == "parse":
+        bench_parse(data)
+    else:
+        results = bench_stages(data) if args.benchmark == "stages" else bench_routes(data, args.requests)
+        try:
+            with open(args.baseline, "r") as file:
+                baselines = json.load(file)
+        except FileNotFoundError:
+            baselines = {}
+
+        key = baseline_key(args)
+        if args.save_baseline:
+            baselines[key] = results
+            with open(args.baseline, "w") as file:
+                json.dump(baselines, file, indent=2, sort_keys=True)
+            print(f"Saved baseline to {args.baseline}")
+        elif key in baselines:
+            if compare_with_baseline(results, baselines[key], args.tolerance):
+                sys.exit(1)
+        else:
+            print(f"No baseline for these settings in {args.baseline}, run with --save-baseline to store one")
+
+
+if __name__ == "__main__":
+    main()
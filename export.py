@@ -0,0 +1,56 @@
+"""Export the KPIs of many companies as a long table of (ticker, cik, label, period_type, period_key, value).
+
+The table is written as CSV, an Arrow IPC stream or Parquet while the companies are processed,
+so memory stays flat however many are exported. Symbols are tickers or CIKs, given on the
+command line, one per line in a file, or taken from the whole ticker mapping with --all.
+
+    python export.py AAPL MSFT > kpis.csv
+    python export.py --all --format parquet --output kpis.parquet
+"""
+import argparse
+import sys
+
+import server
+
+
+def read_symbols(path):
+    with open(path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("symbols", nargs="*", help="tickers or CIKs to export")
+    parser.add_argument("--tickers-file", help="file listing tickers or CIKs, one per line")
+    parser.add_argument("--all", action="store_true", help="export every company of the ticker mapping")
+    parser.add_argument("--labels", default="", help="comma-separated label sets (all by default)")
+    parser.add_argument("--format", choices=sorted(server.EXPORT_FORMATS), default="csv")
+    parser.add_argument("--output", help="file to write to (standard output by default)")
+    args = parser.parse_args()
+
+    symbols = list(args.symbols)
+    if args.tickers_file:
+        symbols += read_symbols(args.tickers_file)
+    if args.all:
+        symbols += sorted(server.load_ticker_index()["cik_by_ticker"])
+    symbols = list(dict.fromkeys(symbols))
+    if not symbols:
+        parser.error("no tickers to export")
+    label_names = [label for label in args.labels.split(",") if label]
+    unknown_labels = [label for label in label_names if label not in server.LABELS_SETS]
+    if unknown_labels:
+        parser.error(f"unknown labels: {', '.join(unknown_labels)}")
+    if args.format != "csv" and server.pyarrow is None:
+        parser.error(f"--format {args.format} requires pyarrow")
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in server.export_data(symbols, label_names or None, args.format):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
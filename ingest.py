@@ -0,0 +1,146 @@
+"""Populate the companyfacts cache from the SEC's bulk companyfacts archive.
+
+The archive holds one CIK##########.json member per company. Members are read one at a time
+by a pool of worker processes, which parse the facts LABELS_SETS needs and write them to the
+columnar cache, so memory stays flat however large the archive is. Completed members are
+journaled next to the cache, and an interrupted run picks up where it stopped. With --process,
+the KPIs of each company are computed and cached as well, which makes them available to /screen.
+
+    python ingest.py companyfacts.zip
+    python ingest.py --download --process companyfacts.zip
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import server
+
+SEC_BULK_COMPANYFACTS_URL = "https://www.sec.gov/Archives/edgar/daily-index/xbrl/companyfacts.zip"
+MEMBER_PATTERN = re.compile(r'CIK(\d{10})\.json$')
+PROGRESS_INTERVAL = 2  # seconds between progress lines
+
+
+def download_archive(archive_path, url=SEC_BULK_COMPANYFACTS_URL):
+    """Stream the bulk archive to archive_path through the server's SEC session, reporting progress."""
+    fetcher = server.get_fetcher()
+    fetcher.limiter.acquire()
+    temporary_path = f"{archive_path}.part"
+    with fetcher.session.get(url, stream=True, timeout=fetcher.timeout) as response:
+        response.raise_for_status()
+        total = int(response.headers.get("Content-Length", 0))
+        received = 0
+        reported = time.monotonic()
+        with open(temporary_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                file.write(chunk)
+                received += len(chunk)
+                if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                    reported = time.monotonic()
+                    share = f" ({received / total:.0%})" if total else ""
+                    print(f"Downloaded {received / 2 ** 20:.0f} MB{share}")
+    os.replace(temporary_path, archive_path)
+
+
+def get_journal_path(archive_path, cache_dir):
+    """The journal of an archive is keyed by its name, size and mtime, so a newer archive starts afresh."""
+    stat = os.stat(archive_path)
+    identity = f"{os.path.basename(archive_path)}-{stat.st_size}-{stat.st_mtime_ns}"
+    return os.path.join(cache_dir, f"ingest-{hashlib.sha1(identity.encode()).hexdigest()[:16]}.journal")
+
+
+def read_journal(journal_path):
+    try:
+        with open(journal_path, "r") as file:
+            return {line.strip() for line in file if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+_archives = {}
+
+
+def ingest_member(archive_path, member_name, cache_dir, soft_ttl, hard_ttl, process=False):
+    """Worker process entry point: cache the facts of one archive member, returning its CIK and fact count."""
+    server.CACHE_DIR = cache_dir
+    server.PROCESSED_CACHE_DIR = os.path.join(cache_dir, "processed")
+    server.SERIES_CACHE_DIR = os.path.join(cache_dir, "series")
+    if archive_path not in _archives:
+        _archives[archive_path] = zipfile.ZipFile(archive_path)
+    with _archives[archive_path].open(member_name) as member:
+        text = member.read().decode("utf-8")
+
+    cik = MEMBER_PATTERN.search(member_name).group(1)
+    data = server.parse_companyfacts(text)
+    server.cache_fact_columns(server.cache_path(cik), data, soft_ttl=soft_ttl, hard_ttl=hard_ttl)
+    if process:
+        server.cache_processed_data(cik, server.get_source_version(cik),
+                                    server.process_company_data_incrementally(cik, data))
+    server.track_cache_entry(cik)
+    return cik, sum(len(records) for concepts in data['facts'].values()
+                    for concept in concepts.values() for records in concept['units'].values())
+
+
+def ingest_archive(archive_path, cache_dir=server.CACHE_DIR, workers=None, soft_ttl=None, hard_ttl=None, process=False):
+    """Cache every company of a bulk companyfacts archive, skipping members a previous run already completed."""
+    os.makedirs(cache_dir, exist_ok=True)
+    journal_path = get_journal_path(archive_path, cache_dir)
+    completed = read_journal(journal_path)
+    with zipfile.ZipFile(archive_path) as archive:
+        members = [name for name in archive.namelist() if MEMBER_PATTERN.search(name) and name not in completed]
+    total = len(members) + len(completed)
+    print(f"{total} companies in {archive_path}, {len(completed)} already ingested")
+
+    done = len(completed)
+    failed = 0
+    facts = 0
+    started = reported = time.monotonic()
+    with open(journal_path, "a") as journal, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ingest_member, archive_path, name, cache_dir, soft_ttl, hard_ttl, process): name
+                   for name in members}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                facts += future.result()[1]
+            except Exception as error:
+                failed += 1
+                print(f"Error: Failed to ingest {name}: {error}")
+                continue
+            journal.write(name + "\n")
+            journal.flush()
+            done += 1
+
+            if time.monotonic() - reported >= PROGRESS_INTERVAL or done == total:
+                reported = time.monotonic()
+                rate = (done - len(completed)) / (reported - started)
+                remaining = (total - done - failed) / rate if rate else 0
+                print(f"[{done}/{total}] {done / total:.1%}  {rate:.0f} companies/s  "
+                      f"{facts} facts  ETA {remaining / 60:.1f} min")
+
+    print(f"Ingested {done - len(completed)} companies in {time.monotonic() - started:.1f} s, {failed} failed")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", help="path of the companyfacts.zip archive")
+    parser.add_argument("--download", action="store_true", help="download the archive from the SEC to this path first")
+    parser.add_argument("--cache-dir", default=server.CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (one per core by default)")
+    parser.add_argument("--soft-ttl", type=float, default=None, help="seconds ingested entries stay fresh")
+    parser.add_argument("--hard-ttl", type=float, default=None, help="seconds ingested entries may be served stale")
+    parser.add_argument("--process", action="store_true", help="also compute and cache the KPIs of each company")
+    args = parser.parse_args()
+
+    if args.download:
+        download_archive(args.archive)
+    failed = ingest_archive(args.archive, args.cache_dir, args.workers, args.soft_ttl, args.hard_ttl, args.process)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
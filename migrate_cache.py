@@ -0,0 +1,60 @@
+"""Convert JSON companyfacts cache files (cache/<cik>.json) to the columnar cache format (cache/<cik>.facts).
+
+Each file keeps its timestamp, so converted entries expire when the JSON ones would have.
+
+    python migrate_cache.py [--cache-dir cache] [--keep]
+"""
+import argparse
+import os
+import re
+
+import server
+
+# The JSON cache files were written by cache_data, which puts the timestamp first
+TIMESTAMP_PATTERN = re.compile(r'\{\s*"timestamp"\s*:\s*([-+0-9.eE]+)')
+CIK_FILE_PATTERN = re.compile(r'\d{10}\.json$')
+
+
+def migrate_file(json_path, keep=False):
+    """Convert one JSON cache file next to itself, returning the path of the columnar file."""
+    with open(json_path, "r") as file:
+        text = file.read()
+    match = TIMESTAMP_PATTERN.match(text)
+    if match is None:
+        raise ValueError(f"{json_path} is not a companyfacts cache file")
+
+    facts_path = json_path[:-len(".json")] + ".facts"
+    server.cache_fact_columns(facts_path, server.parse_companyfacts(text), timestamp=float(match.group(1)))
+    if not keep:
+        os.remove(json_path)
+    return facts_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cache-dir", default=server.CACHE_DIR)
+    parser.add_argument("--keep", action="store_true", help="keep the JSON files after converting them")
+    args = parser.parse_args()
+
+    server.CACHE_DIR = args.cache_dir
+    names = sorted(name for name in os.listdir(args.cache_dir) if CIK_FILE_PATTERN.match(name))
+    json_bytes = facts_bytes = 0
+    for number, name in enumerate(names, 1):
+        json_path = os.path.join(args.cache_dir, name)
+        try:
+            size = os.path.getsize(json_path)
+            facts_path = migrate_file(json_path, keep=args.keep)
+        except (OSError, ValueError) as error:
+            print(f"[{number}/{len(names)}] {name}: skipped, {error}")
+            continue
+        server.track_cache_entry(name[:-len(".json")])
+        json_bytes += size
+        facts_bytes += os.path.getsize(facts_path)
+        print(f"[{number}/{len(names)}] {name} -> {os.path.basename(facts_path)}")
+
+    if json_bytes:
+        print(f"Converted {json_bytes / 2 ** 20:.1f} MB of JSON into {facts_bytes / 2 ** 20:.1f} MB of columnar cache files")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,258 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import requests
 import json
 import os
+import sys
+import copy
+import contextlib
+import re
+import mmap
+import struct
+import hashlib
+import zlib
+import sqlite3
 from datetime import timedelta
 import time
+import threading
+import queue
+import multiprocessing
+import atexit
 import datetime
-from collections import Counter
 from collections import defaultdict
+from collections import Counter
+from collections import OrderedDict
+from collections import namedtuple
+from functools import lru_cache, reduce
+from operator import attrgetter
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import gzip
+import csv
+import io
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 def load_data_from_file(filename):
     """Load JSON data from a file."""
     with open(filename, "r") as file:
         return json.load(file)
 
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(10))  # 1 KB to 256 MB
+
+# name -> (type, help) of everything /metrics exports
+METRIC_DESCRIPTIONS = {
+    'kpiserver_stage_seconds': ('histogram', 'Time spent in each pipeline stage and cache operation.'),
+    'kpiserver_request_seconds': ('histogram', 'Request latency by route.'),
+    'kpiserver_response_bytes': ('histogram', 'Response body size by route.'),
+    'kpiserver_sec_requests_total': ('counter', 'Requests to the SEC by response status.'),
+    'kpiserver_fetched_bytes_total': ('counter', 'Bytes of companyfacts documents downloaded from the SEC.'),
+    'kpiserver_payload_bytes': ('histogram', 'Size of the companyfacts documents downloaded from the SEC.'),
+    'kpiserver_cache_events_total': ('counter', 'Cache hits, misses, fetches and evictions, summed over all workers.'),
+    'kpiserver_responses_total': ('counter', 'Company responses by outcome: not_modified, cached or rendered.')
+}
+
+class Metrics:
+    """Counters and histograms of this process, exported in the Prometheus text format by /metrics.
+
+    Series are keyed by name and a tuple of (label, value) pairs. Histogram buckets hold
+    non-cumulative counts, they are summed up when rendered."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}  # (name, labels) -> (bounds, [count per bucket and one for +Inf], [sum])
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = (buckets, [0] * (len(buckets) + 1), [0.0])
+            histogram[1][bisect_left(histogram[0], value)] += 1
+            histogram[2][0] += value
+
+    def render(self, extra_counters=()):
+        """Render every series, plus (name, labels, value) counters kept elsewhere."""
+        with self.lock:
+            counters = [(name, labels, value) for (name, labels), value in self.counters.items()]
+            histograms = [(name, labels, bounds, list(counts), total[0])
+                          for (name, labels), (bounds, counts, total) in self.histograms.items()]
+        counters.extend(extra_counters)
+
+        lines = []
+        for metric, (kind, description) in METRIC_DESCRIPTIONS.items():
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, labels, value in counters:
+                if name == metric:
+                    lines.append(f"{name}{format_metric_labels(labels)} {value:g}")
+            for name, labels, bounds, counts, total in histograms:
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, count in zip([*bounds, '+Inf'], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_metric_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{format_metric_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+
+# The stage timings of the current request, when it asked for a profile
+_request_profile = threading.local()
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Time a pipeline stage or cache operation, as a with block or a decorator.
+
+    The time goes to the kpiserver_stage_seconds histogram, and to the profile of the current
+    request if it asked for one."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('kpiserver_stage_seconds', elapsed, stage=stage)
+        stages = getattr(_request_profile, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + elapsed
+
+# The colon between an object key and an object, e.g. ':{' in '"us-gaap":{'. Matching on it keeps the
+# scan fast. Only keys are followed by a colon, and quotes inside string values are escaped, so a
+# match preceded by an unescaped quote always ends a key, whatever the whitespace or key order.
+OBJECT_KEY_END_PATTERN = re.compile(r':\s*\{')
+JSON_WHITESPACE = ' \t\n\r'
+# Taxonomy keys under "facts" are lower case ("dei", "us-gaap", "ifrs-full"), concept names are not
+NAMESPACE_PATTERN = re.compile(r'[a-z][a-z0-9-]*$')
+STRUCTURAL_KEYS = {'data', 'facts', 'units'}
+ENTITY_PATTERN = re.compile(r'"(cik|entityName)"\s*:\s*')
+
+_json_decoder = json.JSONDecoder()
+
+def is_escaped(text, index):
+    """Check whether the character at index is escaped, i.e. preceded by an odd number of backslashes."""
+    start = index
+    while start and text[start - 1] == '\\':
+        start -= 1
+    return (index - start) % 2 == 1
+
+def read_object_key(text, end):
+    """Decode the JSON string whose closing quote is at end.
+
+    If the quote at end opens a string value instead (one starting with ': {'), what gets decoded
+    is the punctuation between two strings, which never names a namespace or concept."""
+    start = text.rfind('"', 0, end)
+    while start > 0 and is_escaped(text, start):
+        start = text.rfind('"', 0, start)
+    return json.decoder.scanstring(text, start + 1, False)[0]
+
+def read_entity_fields(text, start, end, data):
+    """Decode the cik and entityName members found between start and end into data, unless already there."""
+    for match in ENTITY_PATTERN.finditer(text, start, end):
+        if match.group(1) not in data and not is_escaped(text, match.start()):
+            data[match.group(1)] = _json_decoder.raw_decode(text, match.end())[0]
+
+DEFAULT_NAMESPACE = 'us-gaap'
+
+def split_concept(name):
+    """Split a concept name qualified with its namespace ('ifrs-full:Revenue') into (namespace, concept).
+
+    Unqualified names are us-gaap concepts."""
+    namespace, _, concept = name.rpartition(':')
+    return namespace or DEFAULT_NAMESPACE, concept
+
+def get_wanted_concepts():
+    """Map each namespace to the concepts read by EXTRACTION_PLAN and the units they are read in."""
+    return EXTRACTION_PLAN.wanted
+
+@stage_timer('parse')
+def parse_companyfacts(text, wanted=None):
+    """Selectively parse a companyfacts JSON document, or a cache file wrapping one.
+
+    Instead of decoding the whole document, the text is scanned for object keys and only the
+    concepts listed in wanted ({namespace: {concept: units}}, see get_wanted_concepts) are decoded,
+    with raw_decode at the offset of their value. Everything else is skipped without being
+    materialized. The result has the companyfacts shape, restricted to
+    facts.<namespace>.<concept>.units.<unit> for the wanted units.
+
+    The document is scanned as one string rather than streamed: the SEC sends it as a single
+    response body anyway, and what json.load costs on top of the text is the object graph of
+    every concept, which is never built here."""
+    if not re.match(r'\s*\{', text):
+        raise ValueError('companyfacts document is not a JSON object')
+    wanted = get_wanted_concepts() if wanted is None else wanted
+
+    data = {'facts': {namespace: {} for namespace in wanted}}
+    namespace = None
+    position = 0
+    while True:
+        match = OBJECT_KEY_END_PATTERN.search(text, position)
+        if match is None:
+            break
+        position = match.end()
+        key_end = match.start()
+        while text[key_end - 1] in JSON_WHITESPACE:
+            key_end -= 1
+        if text[key_end - 1] != '"' or is_escaped(text, key_end - 1):
+            continue  # a colon inside a string
+        key = read_object_key(text, key_end - 1)
+        if key in STRUCTURAL_KEYS:
+            continue
+        if NAMESPACE_PATTERN.match(key):
+            if namespace is None:
+                # Entity fields usually precede the facts, decode them while we're here
+                read_entity_fields(text, 0, match.start(), data)
+            namespace = key
+            continue
+
+        units = wanted.get(namespace, {}).get(key)
+        if units is None:
+            continue
+        concept, position = _json_decoder.raw_decode(text, match.end() - 1)
+        data['facts'][namespace][key] = {'units': {unit: records for unit, records in concept.get('units', {}).items()
+                                                  if unit in units}}
+    if 'cik' not in data or 'entityName' not in data:
+        # Entity fields following the facts come after the last object key
+        read_entity_fields(text, position, len(text), data)
+    return data
+
+def get_concept_units(data, name):
+    """The units of a possibly namespace-qualified concept in a companyfacts dict, empty if it isn't reported."""
+    namespace, concept = split_concept(name)
+    return data["facts"].get(namespace, {}).get(concept, {}).get("units", {})
+
 def extract_data_from_labels(data, labels, expected_unit):
     """Extract data from specified labels and return if matches the expected unit."""
     extracted_data = []
     for label in labels:
-        label_data = data["facts"]["us-gaap"].get(label, {}).get("units", {})
+        label_data = get_concept_units(data, label)
         if expected_unit in label_data:
             extracted_data.extend(label_data[expected_unit])
     return extracted_data
@@ -30,7 +265,7 @@ def extract_and_sum_data_from_labels(data, labels, expected_unit):
         if isinstance(label, list):
             summed_data = []
             for sub_label in label:
-                sub_data = data["facts"]["us-gaap"].get(sub_label, {}).get("units", {})
+                sub_data = get_concept_units(data, sub_label)
                 if expected_unit in sub_data:
                     if summed_data:
                         summed_data = [x + y for x, y in zip(summed_data, sub_data[expected_unit])]
@@ -38,7 +273,7 @@ def extract_and_sum_data_from_labels(data, labels, expected_unit):
                         summed_data = sub_data[expected_unit]
             extracted_data.extend(summed_data)
         else:
-            label_data = data["facts"]["us-gaap"].get(label, {}).get("units", {})
+            label_data = get_concept_units(data, label)
             datas = []
             if expected_unit in label_data:
                 # for record in label_data[expected_unit]:
@@ -53,81 +288,181 @@ def extract_and_sum_data_from_labels(data, labels, expected_unit):
     return extracted_data
 
 
+@lru_cache(maxsize=65536)
+def parse_ordinal(date_str):
+    """Parse a 'YYYY-MM-DD' string into a proleptic Gregorian day ordinal."""
+    return datetime.date.fromisoformat(date_str).toordinal()
+
+@lru_cache(maxsize=65536)
+def format_ordinal(ordinal):
+    """Format a day ordinal back into a 'YYYY-MM-DD' string."""
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+class Fact:
+    """A companyfacts record parsed once for the pipeline, with its dates held as day ordinals.
+
+    start is None for instant facts, which only have an end date."""
+    __slots__ = ('start', 'end', 'val', 'accn', 'fy', 'fp', 'form', 'filed')
+
+    def __init__(self, start, end, val, accn=None, fy=None, fp=None, form=None, filed=None):
+        self.start = start
+        self.end = end
+        self.val = val
+        self.accn = accn
+        self.fy = fy
+        self.fp = fp
+        self.form = form
+        self.filed = filed
+
+    @classmethod
+    def from_record(cls, record):
+        start = record.get('start')
+        filed = record.get('filed')
+        fp = record.get('fp')
+        form = record.get('form')
+        return cls(parse_ordinal(start) if start else None, parse_ordinal(record['end']), record['val'],
+                   record.get('accn'), record.get('fy'), sys.intern(fp) if fp else fp,
+                   sys.intern(form) if form else form, parse_ordinal(filed) if filed else None)
+
+    def to_record(self):
+        """Convert back to a companyfacts-style dict with 'YYYY-MM-DD' dates."""
+        record = {'end': format_ordinal(self.end), 'val': self.val, 'accn': self.accn, 'fy': self.fy,
+                  'fp': self.fp, 'form': self.form, 'filed': format_ordinal(self.filed) if self.filed else None}
+        if self.start is not None:
+            record['start'] = format_ordinal(self.start)
+        return record
+
+    def __repr__(self):
+        return repr(self.to_record())
+
+def parse_facts(records):
+    """Parse companyfacts records into Facts."""
+    return [Fact.from_record(record) for record in records]
+
+class ExtractionPlan:
+    """Which label sets read each (namespace, concept, unit), compiled once from the label sets.
+
+    Extraction walks the concepts of a company once, materializing the facts of each concept/unit
+    a single time and routing them to every label set that reads it, so a concept shared between
+    label sets (CommonStockSharesOutstanding, say) isn't extracted once per label set. Concepts
+    are named as in LABELS_SETS, optionally qualified with their namespace (see split_concept)."""
+
+    def __init__(self, label_sets):
+        self.label_sets = label_sets
+        # (namespace, concept, unit) -> [(label set name, rank)], rank being the concept's position in the label set
+        self.routes = {}
+        self.wanted = {}
+        for label_name, (labels, expected_unit) in label_sets.items():
+            for rank, name in enumerate(labels):
+                if not isinstance(name, str):
+                    raise ValueError(f"The concepts of {label_name} must be names, summed (nested) concept lists aren't supported")
+                namespace, concept = split_concept(name)
+                self.routes.setdefault((namespace, concept, expected_unit), []).append((label_name, rank))
+                self.wanted.setdefault(namespace, {}).setdefault(concept, set()).add(expected_unit)
+
+    def extract(self, data, label_names=None, end_range=None, known_accns=None):
+        """Extract the Facts of the given label sets (all by default) from a companyfacts dict or cached FactColumns.
+
+        Returns {label set name: [(rank, Fact)]}, each list ordered by rank, then as filed. The rank
+        decides which of two facts for the same period deduplicate_data would have kept. With an
+        (end_from, end_to) pair of day ordinals, only facts ending within it are kept, and with
+        known_accns ({label set name: accession numbers}) only facts of other filings."""
+        ranked_facts = {label_name: {} for label_name in (self.label_sets if label_names is None else label_names)}
+        if isinstance(data, FactColumns) and known_accns is not None:
+            known_masks = {label_name: data.known_accn_mask(known_accns[label_name]) for label_name in ranked_facts}
+
+        for key, routes in self.routes.items():
+            routes = [(label_name, rank) for label_name, rank in routes if label_name in ranked_facts]
+            if not routes:
+                continue
+            if isinstance(data, FactColumns):
+                rows = data.rows(*key, end_range)
+                if known_accns is None:
+                    selections = [(data.materialize(rows), None)] * len(routes)
+                else:
+                    # Facts are only built for rows some label set hasn't merged yet
+                    accns = data.columns['accn'][rows]
+                    masks = [~known_masks[label_name][accns] for label_name, _ in routes]
+                    needed = np.logical_or.reduce(masks)
+                    facts = data.materialize(rows[needed])
+                    selections = [(facts, mask[needed]) for mask in masks]
+            else:
+                namespace, concept, unit = key
+                records = data['facts'].get(namespace, {}).get(concept, {}).get('units', {}).get(unit, [])
+                facts = parse_facts(records)
+                if end_range is not None:
+                    facts = [fact for fact in facts if end_range[0] <= fact.end <= end_range[1]]
+                if known_accns is None:
+                    selections = [(facts, None)] * len(routes)
+                else:
+                    selections = [(facts, [fact.accn not in known_accns[label_name] for fact in facts])
+                                  for label_name, _ in routes]
+
+            for (label_name, rank), (facts, selected) in zip(routes, selections):
+                if selected is not None:
+                    facts = [fact for fact, keep in zip(facts, selected) if keep]
+                ranked_facts[label_name].setdefault(rank, []).extend(facts)
+
+        return {label_name: [(rank, fact) for rank in sorted(facts_by_rank) for fact in facts_by_rank[rank]]
+                for label_name, facts_by_rank in ranked_facts.items()}
+
 def deduplicate_data(data):
-    """Deduplicate data based on start and end dates and fiscal period."""
+    """Deduplicate facts based on start and end dates and fiscal period."""
     unique_data = {}
-    for record in data:
-        if is_valid_period(record):
-            if "start" not in record:
-                date_obj = datetime.datetime.strptime(record["end"], "%Y-%m-%d")
+    for fact in data:
+        if is_valid_period(fact):
+            if fact.start is None:
+                # Instant facts are taken to cover the year up to their date
+                fact = copy.copy(fact)
+                fact.start = fact.end - 365
+            key = (fact.start, fact.end, fact.fp)
+            if key not in unique_data:
+                unique_data[key] = fact
+    return sorted(unique_data.values(), key=attrgetter('start'))
 
-                # Subtract one year
-                new_date_obj = date_obj - timedelta(days=365)
+def is_valid_period(fact):
+    """Check if fact has a valid period for annual or quarterly data."""
+    if fact.start is None:
+        return fact.fp == "FY"
 
-                # Convert the new datetime object back to string format
-                new_date_string = new_date_obj.strftime("%Y-%m-%d")
-                record["start"] = new_date_string
-            key = (record["start"], record["end"], record["fp"])
-            if key not in unique_data:
-                unique_data[key] = record
-    return sorted(list(unique_data.values()), key=lambda x: x["start"])
-
-def is_valid_period(record):
-    if "start" not in record:
-        return record["fp"] == "FY"
-    """Check if record has a valid period for annual or quarterly data."""
-    start_date = datetime.datetime.strptime(record["start"], "%Y-%m-%d")
-    end_date = datetime.datetime.strptime(record["end"], "%Y-%m-%d")
-    
-    duration = (end_date - start_date).days + 1  # Including the start day
+    duration = fact.end - fact.start + 1  # Including the start day
     
-    if record["fp"] == "FY" and duration > 330:  # Note: This does not account for leap years
+    if fact.fp == "FY" and duration > 330:  # Note: This does not account for leap years
         return True
-    if record["fp"] in ["Q1", "Q2", "Q3", "Q4"] and (duration >= 80 and duration <= 100):  # Assuming each quarter has 91 days
+    if fact.fp in ("Q1", "Q2", "Q3", "Q4") and (duration >= 80 and duration <= 100):  # Assuming each quarter has 91 days
         return True
     return False
 
+@lru_cache(maxsize=65536)
 def get_fiscal_year_from_dates(start_date, end_date):
-    # Count the days in each year
-    days_counter = Counter()
-
-    # Consider each date in the range
-    current_date = start_date
-    while current_date <= end_date:
-        days_counter[current_date.year] += 1
-        current_date += timedelta(days=1)
-
-    # Find the year with the maximum number of days
-    fiscal_year, _ = days_counter.most_common(1)[0]
-    return fiscal_year
-
+    """Get the calendar year holding the majority of days between start and end dates (earliest on ties)."""
+    day = type(start_date)
+    days_in_year = {}
+    for year in range(start_date.year, end_date.year + 1):
+        year_start = max(day(year, 1, 1), start_date)
+        year_end = min(day(year, 12, 31), end_date)
+        days_in_year[year] = (year_end - year_start).days + 1
+
+    # max() keeps the first year with the maximum number of days
+    return max(days_in_year, key=days_in_year.get)
+
+@lru_cache(maxsize=65536)
 def get_quarter_from_dates(start_date, end_date):
-    # Define the quarters
-    quarters = {
-        'Q1': ((1, 1), (3, 31)),
-        'Q2': ((4, 1), (6, 30)),
-        'Q3': ((7, 1), (9, 30)),
-        'Q4': ((10, 1), (12, 31))
-    }
-
-    # Count the days in each quarter
-    days_counter = Counter()
-
-    # Consider each date in the range
-    current_date = start_date
-    while current_date <= end_date:
-        # Find the quarter for the current date
-        for quarter, ((start_month, start_day), (end_month, end_day)) in quarters.items():
-            if current_date.month >= start_month and current_date.month <= end_month:
-                if (current_date.month == start_month and current_date.day >= start_day) or \
-                   (current_date.month == end_month and current_date.day <= end_day) or \
-                   (current_date.month > start_month and current_date.month < end_month):
-                    days_counter[quarter] += 1
-        current_date += timedelta(days=1)
-
-    # Find the quarter with the maximum number of days
-    quarter, _ = days_counter.most_common(1)[0]
-    return quarter
+    """Get the calendar quarter holding the majority of days between start and end dates.
+
+    Ties go to the quarter reached first from start_date."""
+    day = type(start_date)
+    days_in_quarter = {}
+    year, month = start_date.year, (start_date.month - 1) // 3 * 3 + 1
+    while day(year, month, 1) <= end_date:
+        next_year, next_month = (year + 1, 1) if month == 10 else (year, month + 3)
+        quarter_start = max(day(year, month, 1), start_date)
+        quarter_end = min(day(next_year, next_month, 1) - timedelta(days=1), end_date)
+        quarter = f"Q{(month - 1) // 3 + 1}"
+        days_in_quarter[quarter] = days_in_quarter.get(quarter, 0) + (quarter_end - quarter_start).days + 1
+        year, month = next_year, next_month
+
+    return max(days_in_quarter, key=days_in_quarter.get)
 
 def estimate_missing_quarterly_value(data):
     """Estimate missing quarterly value for years with one missing quarter."""
@@ -267,62 +602,57 @@ def append_missing_quarters(json_data):
 def parse_date(date_str):
     return datetime.datetime.strptime(date_str, '%Y-%m-%d')
 
-# Function to add missing quarterly data to the list of records
+# Function to add missing quarterly data to the list of facts
 def add_missing_quarter_data(revenues):
-    # Separate full year and quarter data
-    full_years = [r for r in revenues if r['fp'] == 'FY']
-    quarters = [r for r in revenues if 'Q' in r['fp']]
+    # Separate full year and quarter data, quarters sorted by their start date
+    full_years = [r for r in revenues if r.fp == 'FY']
+    quarters = sorted((r for r in revenues if 'Q' in r.fp), key=attrgetter('start'))
+    quarter_starts = [q.start for q in quarters]
 
     # Process each full year to find and add missing quarters
     for fy in full_years:
-        fy_start = parse_date(fy['start'])
-        fy_end = parse_date(fy['end'])
+        missing_quarter = infer_missing_quarter(fy, quarters, quarter_starts)
+        if missing_quarter is not None:
+            revenues.append(missing_quarter)
 
-        # Sort quarters within the fiscal year by their start date
-        fy_quarters = [q for q in quarters if parse_date(q['start']) >= fy_start and parse_date(q['end']) <= fy_end]
-        fy_quarters.sort(key=lambda q: q['start'])
+    # Return the updated list, including the newly added missing quarters
+    return revenues
 
-        if len(fy_quarters) != 3:
-            continue
-        # Calculate the covered range by quarters
-        covered_range = []
-        for q in fy_quarters:
-            q_start = parse_date(q['start'])
-            q_end = parse_date(q['end'])
-            covered_range.append((q_start, q_end))
-
-        # Find the gap in the covered range for the missing quarter
-        prev_end = fy_start
-        for start, end in covered_range:
-            if start != prev_end:
-                # This gap is where the missing quarter lies
-                missing_start = prev_end
-                missing_end = start - timedelta(days=1)
+def infer_missing_quarter(fy, quarters, quarter_starts):
+    """Return the 'QX' Fact of a fiscal year with exactly three known quarters, or None.
+
+    quarters must be sorted by start date, quarter_starts holding their start dates."""
+    # Quarters within the fiscal year start inside it, so only that slice of the sorted quarters is scanned
+    fy_quarters = []
+    for i in range(bisect_left(quarter_starts, fy.start), bisect_right(quarter_starts, fy.end)):
+        if quarters[i].end <= fy.end:
+            fy_quarters.append(quarters[i])
+            if len(fy_quarters) > 3:
                 break
-            prev_end = end + timedelta(days=1)
-        else:
-            # If no gap found, the missing quarter is after the last known quarter
+
+    if len(fy_quarters) != 3:
+        return None
+
+    # Find the gap in the covered range for the missing quarter
+    prev_end = fy.start
+    for q in fy_quarters:
+        if q.start != prev_end:
+            # This gap is where the missing quarter lies
             missing_start = prev_end
-            missing_end = fy_end
-
-        # Calculate the missing quarter's revenue
-        known_revenue = sum(q['val'] for q in fy_quarters)
-        missing_revenue = fy['val'] - known_revenue
-
-        # Add the missing quarter record
-        revenues.append({
-            'start': missing_start.strftime('%Y-%m-%d'),
-            'end': missing_end.strftime('%Y-%m-%d'),
-            'val': missing_revenue,
-            'accn': fy['accn'],
-            'fy': fy['fy'],
-            'fp': 'QX',  # Placeholder for 'unknown' quarter
-            'form': fy['form'],
-            'filed': fy['filed']
-        })
+            missing_end = q.start - 1
+            break
+        prev_end = q.end + 1
+    else:
+        # If no gap found, the missing quarter is after the last known quarter
+        missing_start = prev_end
+        missing_end = fy.end
 
-    # Return the updated list, including the newly added missing quarters
-    return revenues
+    # Calculate the missing quarter's revenue
+    known_revenue = sum(q.val for q in fy_quarters)
+    missing_revenue = fy.val - known_revenue
+
+    # 'QX' is a placeholder for the 'unknown' quarter
+    return Fact(missing_start, missing_end, missing_revenue, fy.accn, fy.fy, 'QX', fy.form, fy.filed)
 
 
 # def estimate_missing_quarterly_value(data):
@@ -416,20 +746,17 @@ def get_quarter(start_date, end_date):
     return majority_quarter
 
 def format_data(data):
-    """Format the annual data as 'YYYY' and quarterly data based on start and end dates."""
+    """Format the annual facts as 'YYYY' and quarterly facts by their end date, as a JSON-ready dict."""
     formatted_data = {}
-    for record in data:
-        start_date = datetime.datetime.strptime(record['start'], "%Y-%m-%d")
-        end_date = datetime.datetime.strptime(record['end'], "%Y-%m-%d")
-        
-        if record["fp"] == "FY":
-            key = str(get_fiscal_year_from_dates(start_date, end_date))
+    for fact in data:
+        if fact.fp == "FY":
+            key = str(get_fiscal_year_from_dates(datetime.date.fromordinal(fact.start), datetime.date.fromordinal(fact.end)))
         else:
             # quarter = get_quarter(start_date, end_date)
             # key = f"{end_date.year}-{quarter}"
-            key = record['end']
+            key = format_ordinal(fact.end)
 
-        formatted_data[key] = record["val"]
+        formatted_data[key] = fact.val
     return formatted_data
 
 # def format_data(data):
@@ -448,88 +775,1317 @@ app = Flask(__name__)
 
 CACHE_DIR = "cache"
 
-def cache_data(local_path, data):
+def cache_data(local_path, data, **extra):
     directory = os.path.dirname(local_path)
     if not os.path.exists(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
     
-    with open(local_path, "w") as file:
+    # Written to a temporary file first, so other workers never read a half-written file
+    temporary_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as file:
         json.dump({
             'timestamp': time.time(),
-            'data': data
+            'data': data,
+            **extra
         }, file)
+    os.replace(temporary_path, local_path)
+
+CACHE_DURATION = 3600  # e.g., cache is fresh for 1 hour, then it is served stale while being refreshed
+CACHE_HARD_DURATION = 24 * 3600  # older entries are refreshed before being served
+CACHE_MAX_BYTES = 10 * 2 ** 30  # disk budget of the per-CIK cache files, None for no limit
+CACHE_EVICTION_POLICY = 'lru'  # 'lru' evicts the least recently used CIKs first, 'lfu' the least used ones
+# 'zlib' compresses the fact columns of cache files severalfold, but then every load decompresses
+# them into memory instead of memory-mapping them, so it only pays off when disk is tighter than CPU
+CACHE_COMPRESSION = None
+CACHE_COMPRESSION_LEVEL = 6
+MAX_CONCURRENT_REFRESHES = 4  # background refreshes of stale entries running at once
+MAX_PENDING_REFRESHES = 1000  # stale entries waiting for a background refresh
+
+# Companyfacts are cached per CIK in a columnar file holding only the facts LABELS_SETS reads:
+#
+#   FACTS_FILE_PREFIX: magic, format version, header length, timestamp, the entry's soft and
+#                      hard TTLs in seconds, and a hash of the header and columns
+#   JSON header:       cik, entityName, the SEC response's validators (ETag, Last-Modified),
+#                      string table, column offsets and one
+#                      [namespace, concept, unit, first row, row count] block per concept/unit
+#   columns:           one fixed-width array per field, each aligned to 8 bytes
+#
+# Loading memory-maps the file and views the columns as NumPy arrays without copying them.
+FACTS_FILE_MAGIC = b'KPIFACTS'
+FACTS_FILE_VERSION = 2
+FACTS_FILE_PREFIX = struct.Struct('<8sIIdddQ')
+FACTS_FILE_TIMESTAMP_OFFSET = 16
+
+CachePrefix = namedtuple('CachePrefix', ['timestamp', 'soft_ttl', 'hard_ttl', 'content_hash'])
+
+# Dates are day ordinals and fy a year, 0 when absent. fp, form and accn index the string
+# table, whose entry 0 is None. Values are stored as float64 and flagged when they were ints.
+FACT_COLUMNS = [
+    ('start', '<i4'), ('end', '<i4'), ('filed', '<i4'), ('fy', '<i4'),
+    ('accn', '<i4'), ('fp', '<u2'), ('form', '<u2'), ('val', '<f8'), ('flags', 'u1')
+]
+FACT_VAL_IS_INT = 1
+
+def cache_path(cik):
+    """Location of the columnar companyfacts cache file of a CIK."""
+    return os.path.join(CACHE_DIR, f"{cik}.facts")
+
+@stage_timer('cache_write')
+def cache_fact_columns(local_path, data, timestamp=None, wanted=None, soft_ttl=None, hard_ttl=None, validators=None):
+    """Write the wanted concepts (get_wanted_concepts() by default) of a companyfacts payload as a columnar cache file.
+
+    Every wanted concept/unit gets a block, possibly empty, so a later load can tell it was looked for.
+    The entry is fresh for soft_ttl seconds and servable for hard_ttl (CACHE_DURATION and CACHE_HARD_DURATION by default).
+    validators holds the 'etag' and 'last_modified' of the response the payload came from, for conditional refreshes."""
+    wanted = get_wanted_concepts() if wanted is None else wanted
+    strings = {None: 0}
+    columns = {name: [] for name, _ in FACT_COLUMNS}
+    blocks = []
+    for namespace, concepts in wanted.items():
+        namespace_facts = data.get('facts', {}).get(namespace, {})
+        for concept, units in concepts.items():
+            concept_units = namespace_facts.get(concept, {}).get('units', {})
+            for unit in sorted(units):
+                records = concept_units.get(unit, [])
+                blocks.append([namespace, concept, unit, len(columns['end']), len(records)])
+                for record in records:
+                    start, filed, fy = record.get('start'), record.get('filed'), record.get('fy')
+                    columns['start'].append(parse_ordinal(start) if start else 0)
+                    columns['end'].append(parse_ordinal(record['end']))
+                    columns['filed'].append(parse_ordinal(filed) if filed else 0)
+                    columns['fy'].append(fy or 0)
+                    columns['accn'].append(strings.setdefault(record.get('accn'), len(strings)))
+                    columns['fp'].append(strings.setdefault(record.get('fp'), len(strings)))
+                    columns['form'].append(strings.setdefault(record.get('form'), len(strings)))
+                    columns['val'].append(record['val'])
+                    columns['flags'].append(FACT_VAL_IS_INT if isinstance(record['val'], int) else 0)
+
+    offset = 0
+    column_offsets = {}
+    arrays = []
+    for name, dtype in FACT_COLUMNS:
+        array = np.asarray(columns[name], dtype=dtype)
+        column_offsets[name] = offset
+        arrays.append(array)
+        offset += -(-array.nbytes // 8) * 8
+    column_bytes = b''.join(array.tobytes() + b'\0' * (-array.nbytes % 8) for array in arrays)
+    header = {
+        'cik': data.get('cik'),
+        'entityName': data.get('entityName'),
+        'validators': validators or {},
+        'strings': list(strings),
+        'rows': len(columns['end']),
+        'columns': column_offsets,
+        'blocks': blocks
+    }
+    # The content hash covers the uncompressed columns, so it doesn't depend on CACHE_COMPRESSION
+    content_hash = hashlib.blake2b(json.dumps(header).encode(), digest_size=8)
+    content_hash.update(column_bytes)
+    if CACHE_COMPRESSION == 'zlib':
+        header['compression'] = 'zlib'
+        column_bytes = zlib.compress(column_bytes, CACHE_COMPRESSION_LEVEL)
+    header = json.dumps(header).encode()
+    header += b' ' * (-(FACTS_FILE_PREFIX.size + len(header)) % 8)
 
-CACHE_DURATION = 3600  # e.g., cache is valid for 1 hour
+    directory = os.path.dirname(local_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
 
-def load_cached_data(local_path):
+    # Readers may have the file memory-mapped, so it is replaced rather than rewritten in place
+    temporary_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(FACTS_FILE_PREFIX.pack(FACTS_FILE_MAGIC, FACTS_FILE_VERSION, len(header),
+                                          time.time() if timestamp is None else timestamp,
+                                          CACHE_DURATION if soft_ttl is None else soft_ttl,
+                                          CACHE_HARD_DURATION if hard_ttl is None else hard_ttl,
+                                          int.from_bytes(content_hash.digest(), 'little')))
+        file.write(header)
+        file.write(column_bytes)
+    os.replace(temporary_path, local_path)
+
+def read_cache_prefix(local_path):
+    """Read the CachePrefix of a columnar cache file, or None if there is no valid file."""
     try:
-        with open(local_path, "r") as file:
-            cached_content = json.load(file)
-            cached_time = cached_content['timestamp']
-            if (time.time() - cached_time) <= CACHE_DURATION:
-                return cached_content['data']
+        with open(local_path, "rb") as file:
+            prefix = file.read(FACTS_FILE_PREFIX.size)
     except FileNotFoundError:
-        pass
-    return None  # Return None if the cache is invalid or the file does not exist
+        return None
+    if len(prefix) < FACTS_FILE_PREFIX.size:
+        return None
+    magic, version, _, *fields = FACTS_FILE_PREFIX.unpack(prefix)
+    if magic != FACTS_FILE_MAGIC or version != FACTS_FILE_VERSION:
+        return None
+    return CachePrefix(*fields)
+
+def touch_cache_file(local_path, timestamp=None):
+    """Make a cache entry fresh again by rewriting the timestamp in its prefix, leaving the rest of the file alone."""
+    with open(local_path, "r+b") as file:
+        file.seek(FACTS_FILE_TIMESTAMP_OFFSET)
+        file.write(struct.pack('<d', time.time() if timestamp is None else timestamp))
+
+def get_cache_state(prefix):
+    """'fresh' within an entry's soft TTL, 'stale' within its hard TTL, else (or without an entry) 'expired'."""
+    if prefix is None:
+        return 'expired'
+    age = time.time() - prefix.timestamp
+    if age <= prefix.soft_ttl:
+        return 'fresh'
+    if age <= prefix.hard_ttl:
+        return 'stale'
+    return 'expired'
+
+class FactColumns:
+    """The cached facts of one company, viewed as NumPy arrays over a memory-mapped columnar cache file.
+
+    Compressed files are decompressed into memory instead, their columns can't be mapped directly."""
+
+    def __init__(self, local_path):
+        with open(local_path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length, self.timestamp, _, _, self.content_hash = FACTS_FILE_PREFIX.unpack_from(self._mmap)
+        if magic != FACTS_FILE_MAGIC or version != FACTS_FILE_VERSION:
+            raise ValueError(f"{local_path} is not a version {FACTS_FILE_VERSION} columnar cache file")
+        header = json.loads(self._mmap[FACTS_FILE_PREFIX.size:FACTS_FILE_PREFIX.size + header_length])
+
+        self.cik = header['cik']
+        self.entity_name = header['entityName']
+        self.validators = header.get('validators', {})
+        self.strings = header['strings']
+        data_offset = FACTS_FILE_PREFIX.size + header_length
+        buffer = self._mmap
+        if header.get('compression') == 'zlib':
+            buffer = zlib.decompress(self._mmap[data_offset:])
+            data_offset = 0
+        self.columns = {
+            name: np.frombuffer(buffer, dtype=dtype, count=header['rows'], offset=data_offset + header['columns'][name])
+            for name, dtype in FACT_COLUMNS
+        }
+        self.blocks = {(namespace, concept, unit): (first, count) for namespace, concept, unit, first, count in header['blocks']}
+
+    def covers(self, wanted):
+        """Check whether every wanted concept/unit was looked for when the file was written."""
+        return all((namespace, concept, unit) in self.blocks
+                   for namespace, concepts in wanted.items() for concept, units in concepts.items() for unit in units)
+
+    def rows(self, namespace, concept, unit, end_range=None):
+        """The row indices of a concept/unit, restricted to facts ending within end_range if given."""
+        first, count = self.blocks.get((namespace, concept, unit), (0, 0))
+        if end_range is None:
+            return np.arange(first, first + count)
+        end = self.columns['end'][first:first + count]
+        return first + np.flatnonzero((end >= end_range[0]) & (end <= end_range[1]))
+
+    def known_accn_mask(self, known_accns):
+        """Flag the string table entries found in known_accns.
+
+        Accession numbers are string table indices, so indexing the mask with the accn column
+        tells which rows belong to known filings without building a Fact."""
+        return np.fromiter((string in known_accns for string in self.strings), dtype=bool, count=len(self.strings))
+
+    def materialize(self, rows):
+        """Build the Facts of the given rows (a slice or an index array)."""
+        strings = self.strings
+        columns = [self.columns[name][rows].tolist() for name, _ in FACT_COLUMNS]
+        return [Fact(start or None, end, int(val) if flags & FACT_VAL_IS_INT else val, strings[accn],
+                     fy or None, strings[fp], strings[form], filed or None)
+                for start, end, filed, fy, accn, fp, form, val, flags in zip(*columns)]
+
+@stage_timer('cache_load')
+def load_cached_data(local_path):
+    """Load a columnar cache file whatever its age, or None if there is no usable file."""
+    if read_cache_prefix(local_path) is None:
+        return None  # Return None if the cache is invalid or the file does not exist
 
+    data = FactColumns(local_path)
+    if not data.covers(get_wanted_concepts()):
+        return None  # Written before LABELS_SETS asked for more concepts
+    return data
 
+PROCESSED_CACHE_DIR = os.path.join(CACHE_DIR, "processed")
+PROCESSED_CACHE_SIZE = 256  # number of companies whose processed KPIs are kept in memory
+PIPELINE_VERSION = 2  # bump whenever process_company_data changes its output
 
-def ticker_to_cik(ticker):
-    """Convert ticker symbol to CIK using local mapping."""
-    with open("ticker_cik_mapping.json", "r") as file:
-        mapping = json.load(file)
-    
-    for key, value in mapping.items():
-        if value['ticker'] == ticker.upper():
-            return str(value['cik_str']).zfill(10)  # Convert the CIK to a string, since in your mapping it's an integer
+# cik -> (source version, formatted_data), least recently used first
+_processed_cache = OrderedDict()
+_processed_cache_lock = threading.Lock()
 
-    return None  # Return None if the ticker is not found
+def get_cache_status(cik):
+    """Return the source version and the get_cache_state of the cached companyfacts of a CIK.
 
-def get_data_from_cik(cik):
-    """Retrieve data for a given CIK either from the cache or from the remote server."""
-    local_path = os.path.join(CACHE_DIR, f"{cik}.json")
-    
-    # Check cache first
-    cached_data = load_cached_data(local_path)
-    if cached_data:
-        return cached_data
-    
-    # If not in cache, fetch from remote and store in cache
-    data_url = f"https://data.sec.gov/api/xbrl/companyfacts/CIK{cik}.json"
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
+    The version identifies the cached payload by its content hash, it is None without a cache file."""
+    prefix = read_cache_prefix(cache_path(cik))
+    version = make_source_version(prefix.content_hash) if prefix is not None else None
+    return version, get_cache_state(prefix)
+
+def make_source_version(content_hash):
+    return f"{PIPELINE_VERSION}-{content_hash:016x}"
+
+def get_source_version(cik):
+    return get_cache_status(cik)[0]
+
+def get_data_version(cik, data):
+    """The source version of data returned by get_data_from_cik.
 
-    response = requests.get(data_url, headers=headers)
+    Cached columns know the version of the file they were loaded from, which a refresh may have
+    replaced since. Freshly downloaded data was cached just before, so the file's version is read."""
+    if isinstance(data, FactColumns):
+        return make_source_version(data.content_hash)
+    return get_source_version(cik)
 
-    # Check if the response status code is not 200 OK
-    if response.status_code != 200:
-        print(f"Error: Received status code {response.status_code}")
-        print(response.text)  # Log the raw response to see what's returned
+@stage_timer('processed_cache_load')
+def get_processed_data(cik, version, label_names=None):
+    """Return the memoized process_company_data result for this source version, or None.
+
+    Only the label sets in label_names (all of LABELS_SETS by default) are returned, and all
+    of them must have been processed for this version already."""
+    label_names = list(LABELS_SETS) if label_names is None else label_names
+    with _processed_cache_lock:
+        entry = _processed_cache.get(cik)
+        if entry is not None and entry[0] == version and all(label in entry[1] for label in label_names):
+            _processed_cache.move_to_end(cik)
+            return {label: entry[1][label] for label in label_names}
+
+    try:
+        with open(os.path.join(PROCESSED_CACHE_DIR, f"{cik}.json"), "r") as file:
+            cached_content = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if cached_content.get('version') != version:
         return None
 
+    formatted_data = remember_processed_data(cik, version, cached_content['data'])
+    if not all(label in formatted_data for label in label_names):
+        return None
+    return {label: formatted_data[label] for label in label_names}
+
+def remember_processed_data(cik, version, formatted_data):
+    """Merge processed label sets into the in-memory LRU and return everything known for this version."""
+    with _processed_cache_lock:
+        entry = _processed_cache.get(cik)
+        if entry is not None and entry[0] == version:
+            formatted_data = {**entry[1], **formatted_data}
+        _processed_cache[cik] = (version, formatted_data)
+        _processed_cache.move_to_end(cik)
+        while len(_processed_cache) > PROCESSED_CACHE_SIZE:
+            _processed_cache.popitem(last=False)
+    return formatted_data
+
+@stage_timer('processed_cache_write')
+def cache_processed_data(cik, version, formatted_data):
+    """Memoize a processed result in memory and persist it next to the raw cache."""
+    formatted_data = remember_processed_data(cik, version, formatted_data)
+    cache_data(os.path.join(PROCESSED_CACHE_DIR, f"{cik}.json"), formatted_data, version=version)
+    track_cache_entry(cik)
+
+SERIES_CACHE_DIR = os.path.join(CACHE_DIR, "series")
+
+class LabelSeries:
+    """The deduplicated facts of one label set, with the accession numbers already merged into them.
+
+    Refreshes only merge the facts of filings not seen before and re-infer the missing quarters
+    of the fiscal years those facts touch, instead of reprocessing the company's whole history."""
+
+    def __init__(self, labels, unit):
+        self.labels = labels
+        self.unit = unit
+        self.accns = set()
+        # (rank, *fact row) of the merged facts without an accession number, which known accns can't skip
+        self.unfiled = set()
+        # (start, end, fp) -> (rank, seq, Fact); rank is the position of the fact's concept in labels
+        # and seq its arrival order, which together reproduce the order deduplicate_data sees facts in
+        self.facts = {}
+        # (start, end) of a fiscal year -> its inferred 'QX' Fact
+        self.missing_quarters = {}
+        self.next_seq = 0
+
+    def merge(self, new_facts):
+        """Merge (rank, Fact) pairs the way deduplicate_data would, returning the facts that changed."""
+        changed = []
+        for rank, fact in new_facts:
+            if fact.accn is not None:
+                self.accns.add(fact.accn)
+            else:
+                row = (rank, *fact_to_row(fact))
+                if row in self.unfiled:
+                    # Merged by an earlier refresh, and merging it again would change nothing
+                    continue
+                self.unfiled.add(row)
+            if not is_valid_period(fact):
+                continue
+            if fact.start is None:
+                # Instant facts are taken to cover the year up to their date
+                fact = copy.copy(fact)
+                fact.start = fact.end - 365
+            key = (fact.start, fact.end, fact.fp)
+            existing = self.facts.get(key)
+            # A fact of a higher-priority concept displaces one merged before, otherwise the first one wins
+            if existing is None or rank < existing[0]:
+                self.facts[key] = (rank, self.next_seq, fact)
+                changed.append(fact)
+            self.next_seq += 1
+        return changed
+
+    def update_missing_quarters(self, changed):
+        """Re-infer the missing quarter of every fiscal year covering one of the changed facts."""
+        if not changed:
+            return
+        changed = sorted(changed, key=lambda fact: fact.start)
+        changed_starts = [fact.start for fact in changed]
+        affected = []
+        for _, _, fact in self.facts.values():
+            if fact.fp != 'FY':
+                continue
+            # Only the changed facts starting within the fiscal year can be covered by it
+            for i in range(bisect_left(changed_starts, fact.start), bisect_right(changed_starts, fact.end)):
+                if changed[i].end <= fact.end:
+                    affected.append(fact)
+                    break
+        if not affected:
+            return
+        quarters = [fact for fact in self.ordered_facts() if 'Q' in fact.fp]
+        quarter_starts = [q.start for q in quarters]
+        for fy in affected:
+            missing_quarter = infer_missing_quarter(fy, quarters, quarter_starts)
+            if missing_quarter is not None:
+                self.missing_quarters[(fy.start, fy.end)] = missing_quarter
+            else:
+                self.missing_quarters.pop((fy.start, fy.end), None)
+
+    def ordered_facts(self):
+        """The deduplicated facts sorted by start date, as deduplicate_data returns them."""
+        return [fact for _, _, fact in sorted(self.facts.values(), key=lambda entry: (entry[2].start, entry[0], entry[1]))]
+
+    def completed_facts(self):
+        """The deduplicated facts followed by the missing quarters, as add_missing_quarter_data returns them."""
+        facts = self.ordered_facts()
+        return facts + [self.missing_quarters[(fact.start, fact.end)] for fact in facts
+                        if fact.fp == 'FY' and (fact.start, fact.end) in self.missing_quarters]
+
+    def to_json(self):
+        return {
+            'labels': self.labels,
+            'unit': self.unit,
+            'accns': sorted(self.accns),
+            'unfiled': sorted(self.unfiled, key=repr),
+            'next_seq': self.next_seq,
+            'facts': [[rank, seq, *fact_to_row(fact)] for rank, seq, fact in self.facts.values()],
+            'missing_quarters': [[*key, *fact_to_row(fact)] for key, fact in self.missing_quarters.items()]
+        }
+
+    @classmethod
+    def from_json(cls, content):
+        series = cls(content['labels'], content['unit'])
+        series.accns = set(content['accns'])
+        series.unfiled = {tuple(row) for row in content.get('unfiled', [])}
+        series.next_seq = content['next_seq']
+        for rank, seq, *row in content['facts']:
+            fact = Fact(*row)
+            series.facts[(fact.start, fact.end, fact.fp)] = (rank, seq, fact)
+        for fy_start, fy_end, *row in content['missing_quarters']:
+            series.missing_quarters[(fy_start, fy_end)] = Fact(*row)
+        return series
+
+def fact_to_row(fact):
+    return [fact.start, fact.end, fact.val, fact.accn, fact.fy, fact.fp, fact.form, fact.filed]
+
+@stage_timer('series_load')
+def load_series(cik):
+    """Return the persisted LabelSeries of a CIK by label set name, empty if there are none."""
     try:
-        data = response.json()
-    except json.JSONDecodeError:
-        print("Error decoding JSON from response.")
+        with open(os.path.join(SERIES_CACHE_DIR, f"{cik}.json"), "r") as file:
+            cached_content = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if cached_content.get('pipeline_version') != PIPELINE_VERSION:
+        return {}
+    return {label_name: LabelSeries.from_json(content) for label_name, content in cached_content['data'].items()}
+
+@stage_timer('series_save')
+def save_series(cik, series_by_label):
+    cache_data(os.path.join(SERIES_CACHE_DIR, f"{cik}.json"),
+               {label_name: series.to_json() for label_name, series in series_by_label.items()},
+               pipeline_version=PIPELINE_VERSION)
+
+
+TICKER_MAPPING_FILE = "ticker_cik_mapping.json"
+
+# Ticker/CIK lookups built from TICKER_MAPPING_FILE, rebuilt when the file's mtime changes
+_ticker_index = {'mtime': None, 'cik_by_ticker': {}, 'ticker_by_cik': {}, 'title_by_cik': {}}
+_ticker_index_lock = threading.Lock()
+
+def load_ticker_index():
+    """Return the ticker/CIK index, re-reading the mapping file only if it changed on disk."""
+    global _ticker_index
+    mtime = os.stat(TICKER_MAPPING_FILE).st_mtime_ns
+    if _ticker_index['mtime'] == mtime:
+        return _ticker_index
+
+    with _ticker_index_lock:
+        if _ticker_index['mtime'] != mtime:
+            cik_by_ticker, ticker_by_cik, title_by_cik = {}, {}, {}
+            for value in load_data_from_file(TICKER_MAPPING_FILE).values():
+                cik = str(value['cik_str']).zfill(10)
+                ticker = value['ticker'].upper()
+                # The first entry wins, the SEC file lists a company's primary ticker first
+                cik_by_ticker.setdefault(ticker, cik)
+                ticker_by_cik.setdefault(cik, ticker)
+                title_by_cik.setdefault(cik, value.get('title'))
+            _ticker_index = {
+                'mtime': mtime,
+                'cik_by_ticker': cik_by_ticker,
+                'ticker_by_cik': ticker_by_cik,
+                'title_by_cik': title_by_cik
+            }
+    return _ticker_index
+
+def ticker_to_cik(ticker):
+    """Convert ticker symbol to CIK using local mapping."""
+    return load_ticker_index()['cik_by_ticker'].get(ticker.strip().upper())  # None if the ticker is not found
+
+def cik_to_ticker(cik):
+    """Convert a CIK to its primary ticker symbol, or None if it is not in the mapping."""
+    return load_ticker_index()['ticker_by_cik'].get(str(cik).zfill(10))
+
+def cik_to_title(cik):
+    """Return the company name registered for a CIK, or None if it is not in the mapping."""
+    return load_ticker_index()['title_by_cik'].get(str(cik).zfill(10))
+
+def resolve_cik(symbol):
+    """Resolve a ticker symbol or a numeric CIK to a zero-padded CIK, or None if unknown."""
+    symbol = symbol.strip()
+    if symbol.isdigit():
+        return symbol.zfill(10) if cik_to_ticker(symbol) or os.path.exists(cache_path(symbol.zfill(10))) else None
+    return ticker_to_cik(symbol)
+
+def resolve_tickers(tickers):
+    """Resolve many ticker symbols at once, mapping each to its CIK and company name (None if unknown)."""
+    index = load_ticker_index()
+    resolved = {}
+    for ticker in tickers:
+        cik = index['cik_by_ticker'].get(ticker.strip().upper())
+        resolved[ticker] = {'cik': cik, 'title': index['title_by_cik'][cik]} if cik else None
+    return resolved
+
+SEC_COMPANYFACTS_URL = "https://data.sec.gov/api/xbrl/companyfacts/CIK{cik}.json"
+SEC_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+SEC_MAX_REQUESTS_PER_SECOND = 10  # the SEC's fair access policy
+SEC_TIMEOUT = (5, 60)  # seconds to connect, seconds between bytes received
+SEC_RETRIES = 3
+SEC_RETRY_BACKOFF = 0.5  # seconds before the first retry, doubled for each one after
+SEC_RATE_LIMIT_SHARED = True  # share SEC_MAX_REQUESTS_PER_SECOND between all worker processes through the cache index
+SEC_RATE_LIMIT_MAX_WAIT = 60  # seconds a shared rate limit slot may be reserved ahead
+SEC_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Rate limiter handing out rate tokens per second, up to capacity at once."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class SharedTokenBucket:
+    """TokenBucket whose budget is shared by every worker process using the same cache directory.
+
+    Each acquire reserves the next free slot in the CacheIndex, so gunicorn workers, batch
+    pools and ingest processes together stay within rate. If the index can't be written,
+    the process falls back to a bucket of its own."""
+
+    def __init__(self, rate, capacity=1, key='sec'):
+        self.rate = rate
+        self.capacity = capacity
+        self.key = key
+        self.fallback = TokenBucket(rate, capacity)
+
+    def acquire(self):
+        try:
+            wait = get_cache_index().reserve_slot(self.key, self.rate, self.capacity)
+        except sqlite3.Error as error:
+            print(f"Error: Failed to reserve a shared rate limit slot: {error}")
+            self.fallback.acquire()
+            return
+        if wait > 0:
+            time.sleep(wait)
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one call whose result every caller gets."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+# A downloaded companyfacts document and its validators, text is None if the SEC answered 304 Not Modified
+FetchedDocument = namedtuple('FetchedDocument', ['text', 'etag', 'last_modified'])
+
+class SecFetcher:
+    """Downloads companyfacts documents over a pooled keep-alive session.
+
+    Requests are rate limited with a SharedTokenBucket (a TokenBucket of the process's own with
+    shared_limit False), time out, and are retried with exponential backoff on connection
+    errors and on throttling or server errors. url is formatted with the CIK, so the fetcher
+    can be pointed at a local stub server."""
+
+    def __init__(self, url=SEC_COMPANYFACTS_URL, user_agent=SEC_USER_AGENT, rate=SEC_MAX_REQUESTS_PER_SECOND,
+                 timeout=SEC_TIMEOUT, retries=SEC_RETRIES, backoff=SEC_RETRY_BACKOFF, pool_size=None,
+                 shared_limit=SEC_RATE_LIMIT_SHARED):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = SharedTokenBucket(rate) if shared_limit else TokenBucket(rate)
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": user_agent, "Accept-Encoding": "gzip, deflate"})
+        # One pooled connection per concurrent batch fetch by default
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or BATCH_FETCH_WORKERS)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch(self, cik, etag=None, last_modified=None):
+        """Return the companyfacts document of a CIK as a FetchedDocument, or None if it could not be retrieved.
+
+        Given the validators of an earlier response the request is conditional, and the
+        document's text is None if it hasn't changed since."""
+        data_url = self.url.format(cik=cik)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            with stage_timer('rate_limit_wait'):
+                self.limiter.acquire()
+            try:
+                with stage_timer('fetch'):
+                    response = self.session.get(data_url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as error:
+                metrics.inc('kpiserver_sec_requests_total', status='error')
+                print(f"Error: Request for {data_url} failed: {error}")
+            else:
+                metrics.inc('kpiserver_sec_requests_total', status=str(response.status_code))
+                if response.status_code == 200:
+                    metrics.inc('kpiserver_fetched_bytes_total', len(response.content))
+                    metrics.observe('kpiserver_payload_bytes', len(response.content), SIZE_BUCKETS)
+                if response.status_code == 304:
+                    return FetchedDocument(None, etag, last_modified)
+                if response.status_code == 200:
+                    return FetchedDocument(response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                if response.status_code not in SEC_RETRY_STATUS_CODES:
+                    # Check if the response status code is not 200 OK
+                    print(f"Error: Received status code {response.status_code}")
+                    print(response.text)  # Log the raw response to see what's returned
+                    return None
+                print(f"Error: Received status code {response.status_code}, attempt {attempt + 1} of {self.retries + 1}")
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, min(int(retry_after), 60))
+            if attempt < self.retries:
+                time.sleep(delay)
         return None
 
+_fetcher = None
+_fetcher_pid = None
+_fetcher_lock = threading.Lock()
+
+def get_fetcher():
+    """The process-wide SecFetcher, created on first use in each process so pooled connections aren't shared across forks."""
+    global _fetcher, _fetcher_pid
+    with _fetcher_lock:
+        if _fetcher is None or _fetcher_pid != os.getpid():
+            _fetcher = SecFetcher()
+            _fetcher_pid = os.getpid()
+        return _fetcher
+
+def set_fetcher(fetcher):
+    """Replace the process-wide SecFetcher, e.g. with one pointed at a local stub server."""
+    global _fetcher, _fetcher_pid
+    with _fetcher_lock:
+        _fetcher = fetcher
+        _fetcher_pid = os.getpid()
+
+CACHE_INDEX_FILE = "index.db"  # in CACHE_DIR
+FETCH_LEASE_DURATION = 30  # seconds a CIK's fetch lease outlives its last renewal, e.g. when its worker died
+FETCH_LEASE_RENEW_INTERVAL = 10  # seconds between renewals of a held fetch lease, however long the fetch takes
+FETCH_LEASE_POLL_INTERVAL = 0.05  # seconds between attempts to take a lease held by another worker
+CACHE_STATS_FLUSH_INTERVAL = 1  # seconds cache counters are buffered in memory before being written out
+
+class CacheIndex:
+    """Cache bookkeeping shared by every worker process through a SQLite database in WAL mode.
+
+    It holds the fetch leases that let a single worker download a given CIK, the SEC rate
+    limit shared by all workers, the cache counters of all workers, and the size and accesses
+    of each CIK's cache files for eviction.
+    Counters and accesses are buffered in memory and written at most once per
+    CACHE_STATS_FLUSH_INTERVAL, so recording a hit doesn't cost a write transaction."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.pending = Counter()
+        self.pending_accesses = {}  # cik -> [last access, accesses]
+        self.pending_lock = threading.Lock()
+        self.flushed = time.monotonic()
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, free_at REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                               "(cik TEXT PRIMARY KEY, size INTEGER, last_access REAL, accesses INTEGER)")
+
+    def connect(self):
+        """The calling thread's connection, SQLite connections can't be shared between threads."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def acquire_lease(self, key, owner, duration=FETCH_LEASE_DURATION):
+        """Take the lease on key unless another owner holds an unexpired one, returning whether it was taken."""
+        now = time.time()
+        connection = self.connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT owner, expires FROM leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)",
+                               (key, owner, now + duration))
+            return True
+
+    def release_lease(self, key, owner):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def reserve_slot(self, key, rate, capacity=1):
+        """Reserve the next slot of a rate limit shared by all workers, returning the seconds to wait for it.
+
+        free_at is when the limit's budget is next fully available again. Each reservation pushes
+        it 1 / rate further, and may be taken up to capacity - 1 slots ahead of it."""
+        now = time.time()
+        connection = self.connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT free_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            # Clamped so a clock set back doesn't stall every worker until it catches up
+            free_at = min(max(row[0], now), now + SEC_RATE_LIMIT_MAX_WAIT) if row is not None else now
+            connection.execute("INSERT OR REPLACE INTO rate_limits (key, free_at) VALUES (?, ?)", (key, free_at + 1 / rate))
+        return max(0.0, free_at - now - (capacity - 1) / rate)
+
+    def count(self, name, value=1, cik=None):
+        """Add value to a counter, and record an access to the entry of cik if given."""
+        with self.pending_lock:
+            self.pending[name] += value
+            if cik is not None:
+                access = self.pending_accesses.setdefault(cik, [0, 0])
+                access[0] = time.time()
+                access[1] += 1
+            if time.monotonic() - self.flushed < CACHE_STATS_FLUSH_INTERVAL:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, Counter()
+            accesses, self.pending_accesses = self.pending_accesses, {}
+            self.flushed = time.monotonic()
+        if not pending and not accesses:
+            return
+        try:
+            with self.connect() as connection:
+                connection.executemany("INSERT INTO counters (name, value) VALUES (?, ?) "
+                                       "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                                       pending.items())
+                connection.executemany("UPDATE entries SET last_access = max(last_access, ?), accesses = accesses + ? "
+                                       "WHERE cik = ?", [(*access, cik) for cik, access in accesses.items()])
+        except sqlite3.Error as error:
+            print(f"Error: Failed to write cache counters: {error}")
+
+    def record_entry(self, cik, size):
+        """Record the disk size of the cache files of a CIK after a write, returning the size of the whole cache."""
+        with self.connect() as connection:
+            connection.execute("INSERT INTO entries (cik, size, last_access, accesses) VALUES (?, ?, ?, 1) "
+                               "ON CONFLICT (cik) DO UPDATE SET size = excluded.size, last_access = excluded.last_access",
+                               (cik, size, time.time()))
+            return connection.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()[0]
+
+    def take_evictions(self, max_bytes, policy, keep=None):
+        """Pick the entries to evict for the cache to fit in max_bytes and forget them, returning their CIKs.
+
+        Entries are picked and removed in one transaction, so concurrent workers never pick the same ones."""
+        self.flush()
+        order = "accesses, last_access" if policy == 'lfu' else "last_access"
+        connection = self.connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            total = connection.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()[0]
+            evicted = []
+            for cik, size in connection.execute(f"SELECT cik, size FROM entries ORDER BY {order}").fetchall():
+                if total <= max_bytes:
+                    break
+                if cik != keep:
+                    evicted.append(cik)
+                    total -= size
+            connection.executemany("DELETE FROM entries WHERE cik = ?", [(cik,) for cik in evicted])
+        return evicted
+
+    def summary(self):
+        """Return the number of tracked entries and their total size in bytes."""
+        return self.connect().execute("SELECT count(*), coalesce(sum(size), 0) FROM entries").fetchone()
+
+    def counters(self):
+        """The counters of all workers, including this one's unwritten ones."""
+        self.flush()
+        return dict(self.connect().execute("SELECT name, value FROM counters").fetchall())
+
+_cache_index = None
+_cache_index_key = None
+_cache_index_lock = threading.Lock()
+
+def get_cache_index():
+    """The CacheIndex of CACHE_DIR, opened anew in each process since SQLite connections don't survive forks."""
+    global _cache_index, _cache_index_key
+    key = (os.getpid(), CACHE_DIR)
+    with _cache_index_lock:
+        if _cache_index_key != key:
+            _cache_index = CacheIndex(os.path.join(CACHE_DIR, CACHE_INDEX_FILE))
+            _cache_index_key = key
+        return _cache_index
+
+def cache_entry_paths(cik):
+    """The cache files of a CIK, which are sized and evicted together."""
+    return [cache_path(cik), os.path.join(PROCESSED_CACHE_DIR, f"{cik}.json"), os.path.join(SERIES_CACHE_DIR, f"{cik}.json")]
+
+def track_cache_entry(cik):
+    """Record the size of a CIK's cache files after one of them was written, evicting the entries
+    CACHE_EVICTION_POLICY picks first if the cache outgrew CACHE_MAX_BYTES."""
+    size = 0
+    for local_path in cache_entry_paths(cik):
+        try:
+            size += os.path.getsize(local_path)
+        except FileNotFoundError:
+            pass
+    index = get_cache_index()
+    if index.record_entry(cik, size) <= (CACHE_MAX_BYTES if CACHE_MAX_BYTES is not None else float('inf')):
+        return
+
+    for evicted_cik in index.take_evictions(CACHE_MAX_BYTES, CACHE_EVICTION_POLICY, keep=cik):
+        for local_path in cache_entry_paths(evicted_cik):
+            try:
+                os.remove(local_path)
+            except FileNotFoundError:
+                pass
+        with _processed_cache_lock:
+            _processed_cache.pop(evicted_cik, None)
+        index.count('evictions')
+
+class FetchLease:
+    """Context manager holding the cross-process fetch lease of a CIK, waiting while another worker holds it.
+
+    The lease is renewed every FETCH_LEASE_RENEW_INTERVAL while held, since a fetch waiting on the
+    rate limit and retrying can take longer than any fixed duration, and then the lease would be
+    taken over and the CIK downloaded twice."""
+
+    def __init__(self, cik):
+        self.key = f"fetch:{cik}"
+        self.owner = f"{os.getpid()}:{threading.get_ident()}"
+        self.released = threading.Event()
+
+    def __enter__(self):
+        index = get_cache_index()
+        with stage_timer('fetch_lease_wait'):
+            while not index.acquire_lease(self.key, self.owner, FETCH_LEASE_DURATION):
+                time.sleep(FETCH_LEASE_POLL_INTERVAL)
+        self.renewer = threading.Thread(target=self.renew, name='fetch-lease', daemon=True)
+        self.renewer.start()
+        return self
+
+    def renew(self):
+        while not self.released.wait(FETCH_LEASE_RENEW_INTERVAL):
+            try:
+                renewed = get_cache_index().acquire_lease(self.key, self.owner, FETCH_LEASE_DURATION)
+            except sqlite3.Error as error:
+                print(f"Error: Failed to renew the lease on {self.key}: {error}")
+                continue
+            if not renewed:
+                print(f"Error: The lease on {self.key} expired and was taken over by another worker")
+                return
+
+    def __exit__(self, *exc_info):
+        self.released.set()
+        self.renewer.join()
+        get_cache_index().release_lease(self.key, self.owner)
+
+_refresh_flights = SingleFlight()
+
+_refresh_executor = None
+_refresh_pending = set()
+_refresh_lock = threading.Lock()
+
+def schedule_refresh(cik):
+    """Refresh the cached companyfacts of a CIK on a background worker, unless it is already pending.
+
+    At most MAX_CONCURRENT_REFRESHES run at once, and beyond MAX_PENDING_REFRESHES waiting ones
+    new requests are dropped, to be scheduled again by the next request for the CIK."""
+    global _refresh_executor
+    with _refresh_lock:
+        if cik in _refresh_pending or len(_refresh_pending) >= MAX_PENDING_REFRESHES:
+            return False
+        _refresh_pending.add(cik)
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REFRESHES, thread_name_prefix='refresh')
+    _refresh_executor.submit(background_refresh, cik)
+    return True
+
+def background_refresh(cik):
+    try:
+        if _refresh_flights.run(cik, lambda: refresh_data_from_cik(cik)) is None:
+            print(f"Error: Background refresh of {cik} failed, serving stale data until it expires")
+    except Exception as error:
+        print(f"Error: Background refresh of {cik} failed: {error}")
+    finally:
+        with _refresh_lock:
+            _refresh_pending.discard(cik)
 
-    # Cache the data
-    cache_data(local_path, data)
+def get_data_from_cik(cik):
+    """Retrieve data for a given CIK either from the cache or from the remote server."""
+    # Check cache first, stale data is served right away and refreshed in the background
+    local_path = cache_path(cik)
+    state = get_cache_state(read_cache_prefix(local_path))
+    if state != 'expired':
+        cached_data = load_cached_data(local_path)
+        if cached_data:
+            get_cache_index().count('hits' if state == 'fresh' else 'stale_hits', cik=cik)
+            if state == 'stale':
+                schedule_refresh(cik)
+            return cached_data
+
+    # If not in cache, fetch from remote and store in cache. Concurrent requests for the same CIK share one download.
+    get_cache_index().count('misses')
+    return _refresh_flights.run(cik, lambda: refresh_data_from_cik(cik))
+
+def refresh_data_from_cik(cik):
+    """Download the companyfacts of a CIK, cache the wanted facts and return them, or None on failure.
+
+    If a cached copy exists, the download is conditional on the document having changed since.
+    Only the worker holding the CIK's FetchLease downloads it, the others wait for its result."""
+    local_path = cache_path(cik)
+    with FetchLease(cik):
+        cached_data = load_cached_data(local_path)
+        if cached_data is not None and get_cache_state(read_cache_prefix(local_path)) == 'fresh':
+            # Another worker refreshed the entry while this one was waiting for the lease
+            return cached_data
+        validators = cached_data.validators if cached_data else {}
+
+        document = get_fetcher().fetch(cik, validators.get('etag'), validators.get('last_modified'))
+        if document is None:
+            return None
+        get_cache_index().count('fetches')
+        if document.text is None:
+            # Not modified, the cached facts are just as current as a new download would be
+            get_cache_index().count('not_modified')
+            touch_cache_file(local_path)
+            return cached_data
+
+        try:
+            data = parse_companyfacts(document.text)
+        except ValueError:
+            print("Error decoding JSON from response.")
+            return None
+
+        # Cache the wanted facts in columnar form
+        cache_fact_columns(local_path, data, validators={'etag': document.etag, 'last_modified': document.last_modified})
+    track_cache_entry(cik)
     
     return data
 
+RESPONSE_CACHE_SIZE = 512  # serialized responses kept in memory
+COMPRESSION_MIN_SIZE = 1024  # smaller bodies are sent uncompressed
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# (cik, path, query) -> (source version, etag, {content encoding: body}), least recently used first
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def serialize_json(data):
+    """Serialize to compact JSON bytes with sorted keys, as jsonify does, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+def negotiate_encoding():
+    """Pick br or gzip from the request's Accept-Encoding, or None for an uncompressed response."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def json_response(body, etag=None, encoding=None, cache_key=None):
+    """A JSON response from serialized bytes, compressed with encoding if it is worth it.
+
+    Compressed bodies are kept with the cached response under cache_key."""
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding is not None and len(body) >= COMPRESSION_MIN_SIZE:
+        with _response_cache_lock:
+            entry = _response_cache.get(cache_key)
+            compressed = entry[2].get(encoding) if entry is not None and entry[1] == etag else None
+        if compressed is None:
+            compressed = compress_body(body, encoding)
+            with _response_cache_lock:
+                entry = _response_cache.get(cache_key)
+                if entry is not None and entry[1] == etag:
+                    entry[2][encoding] = compressed
+        body = compressed
+        headers['Content-Encoding'] = encoding
+    response = Response(body, mimetype='application/json', headers=headers)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+def company_json_response(ticker, compute):
+    """Serve the JSON result of compute() for the company of ticker through the response cache.
+
+    compute returns the result and whether it may be cached, i.e. it isn't an error. Results are
+    cached serialized, and compressed per encoding, along with the source version of the company's
+    companyfacts. Their ETag derives from that version and the query, so a client revalidating an
+    unchanged result gets a 304 Not Modified without anything being computed or serialized."""
+    cik = ticker_to_cik(ticker) if ticker else None
+    if cik is None or getattr(_request_profile, 'stages', None) is not None:
+        # Errors and profiled requests go through uncached
+        return json_response(serialize_json(compute()[0]))
+
+    query = tuple(sorted((key, value) for key, value in request.args.items(multi=True) if key != 'profile'))
+    cache_key = (cik, request.path, query)
+    encoding = negotiate_encoding()
+
+    version, state = get_cache_status(cik)
+    if version is not None and state != 'expired':
+        etag = make_response_etag(version, cache_key)
+        if state == 'stale':
+            schedule_refresh(cik)
+        if request.if_none_match.contains_weak(etag):
+            metrics.inc('kpiserver_responses_total', outcome='not_modified')
+            response = Response(status=304, headers={'Vary': 'Accept-Encoding'})
+            response.set_etag(etag, weak=True)
+            return response
+        with _response_cache_lock:
+            entry = _response_cache.get(cache_key)
+            if entry is not None and entry[0] == version:
+                _response_cache.move_to_end(cache_key)
+        if entry is not None and entry[0] == version:
+            metrics.inc('kpiserver_responses_total', outcome='cached')
+            return json_response(entry[2][None], etag, encoding, cache_key)
+
+    result, cacheable = compute()
+    body = serialize_json(result)
+    metrics.inc('kpiserver_responses_total', outcome='rendered')
+    # A result computed while the entry was (re)fetched may come from either version, so it's only
+    # cached if the version it was computed for is still the current one
+    if not cacheable or version is None or get_source_version(cik) != version:
+        return json_response(body, encoding=encoding)
+
+    etag = make_response_etag(version, cache_key)
+    with _response_cache_lock:
+        _response_cache[cache_key] = (version, etag, {None: body})
+        _response_cache.move_to_end(cache_key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+    return json_response(body, etag, encoding, cache_key)
+
+def make_response_etag(version, cache_key):
+    """The ETag of a cached response, sent weak since its gzip, br and identity bodies all share it."""
+    return hashlib.blake2b(repr((version, cache_key)).encode(), digest_size=12).hexdigest()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # ?profile=1 returns the stage breakdown of the request along with its response
+    _request_profile.stages = {} if request.args.get('profile') in ('1', 'true') else None
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('kpiserver_request_seconds', elapsed, route=route)
+    if not response.is_streamed:
+        metrics.observe('kpiserver_response_bytes', response.calculate_content_length() or 0, SIZE_BUCKETS, route=route)
+
+    stages, _request_profile.stages = getattr(_request_profile, 'stages', None), None
+    if stages is not None:
+        response.headers['Server-Timing'] = ", ".join(
+            [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in stages.items()] + [f"total;dur={elapsed * 1000:.3f}"])
+        body = response.get_json(silent=True) if response.is_json and not response.is_streamed else None
+        if isinstance(body, dict):
+            body['profile'] = {'total_ms': elapsed * 1000,
+                               'stages_ms': {stage: seconds * 1000 for stage, seconds in stages.items()}}
+            response.set_data(app.json.dumps(body))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of this worker's stage, request and SEC metrics and of the shared cache counters."""
+    cache_counters = [('kpiserver_cache_events_total', (('event', event),), value)
+                      for event, value in sorted(get_cache_index().counters().items())]
+    return Response(metrics.render(cache_counters), mimetype='text/plain; version=0.0.4')
+
 @app.route('/process_annual', methods=['GET'])
 def process_annual():
-    results = process_data(request.args.get('ticker', default='', type=str))
-    return jsonify(filter_annual_quarterly(results, "annual"))
+    ticker = request.args.get('ticker', default='', type=str)
+
+    def compute():
+        results = process_data(ticker)
+        return filter_annual_quarterly(results, "annual"), 'error' not in results
+    return company_json_response(ticker, compute)
 
 @app.route('/process_quarterly', methods=['GET'])
 def process_quarterly():
-    results = process_data(request.args.get('ticker', default='', type=str))
-    return jsonify(filter_annual_quarterly(results, "quarterly"))
+    ticker = request.args.get('ticker', default='', type=str)
+
+    def compute():
+        results = process_data(ticker)
+        return filter_annual_quarterly(results, "quarterly"), 'error' not in results
+    return company_json_response(ticker, compute)
+
+@app.route('/admin/cache', methods=['GET'])
+def admin_cache():
+    """Size, entry count and hit/miss rates of the cache, summed over all worker processes."""
+    index = get_cache_index()
+    counters = index.counters()
+    entries, size = index.summary()
+    hits = counters.get('hits', 0) + counters.get('stale_hits', 0) + counters.get('processed_hits', 0)
+    lookups = hits + counters.get('misses', 0)
+    return jsonify({
+        'entries': entries,
+        'size_bytes': size,
+        'max_bytes': CACHE_MAX_BYTES,
+        'eviction_policy': CACHE_EVICTION_POLICY,
+        'compression': CACHE_COMPRESSION,
+        'counters': counters,
+        'hit_rate': hits / lookups if lookups else None,
+        'miss_rate': counters.get('misses', 0) / lookups if lookups else None
+    })
+
+@app.route('/resolve', methods=['GET'])
+def resolve():
+    tickers = [ticker for ticker in request.args.get('tickers', default='', type=str).split(',') if ticker.strip()]
+    if not tickers:
+        return jsonify({'error': 'No ticker symbols provided'})
+    return jsonify(resolve_tickers(tickers))
+
+@app.route('/kpis', methods=['GET'])
+def kpis():
+    """Annual and/or quarterly KPIs for a subset of label sets from a single pipeline run.
+
+    metrics= adds DERIVED_METRICS computed from them. Quarterly periods are kept if their end
+    date lies within from/to, annual periods if their fiscal year lies within the years of from/to.
+    as_of= returns the figures as they were known on that date, restatements included."""
+    label_names = [label for label in request.args.get('labels', default='', type=str).split(',') if label]
+    unknown_labels = [label for label in label_names if label not in LABELS_SETS]
+    if unknown_labels:
+        return jsonify({'error': f"Unknown labels: {', '.join(unknown_labels)}"})
+    metric_names = [metric for metric in request.args.get('metrics', default='', type=str).split(',') if metric]
+    unknown_metrics = [metric for metric in metric_names if metric not in DERIVED_METRICS]
+    if unknown_metrics:
+        return jsonify({'error': f"Unknown metrics: {', '.join(unknown_metrics)}"})
+
+    period = request.args.get('period', default='both', type=str)
+    if period not in ('annual', 'quarterly', 'both'):
+        return jsonify({'error': 'period must be one of annual, quarterly or both'})
+
+    try:
+        date_from = datetime.date.fromisoformat(request.args['from']) if 'from' in request.args else None
+        date_to = datetime.date.fromisoformat(request.args['to']) if 'to' in request.args else None
+        as_of = datetime.date.fromisoformat(request.args['as_of']) if 'as_of' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'from, to and as_of must be dates formatted as YYYY-MM-DD'})
+
+    ticker = request.args.get('ticker', default='', type=str)
+
+    def compute():
+        # With metrics but no labels, only the metrics are returned
+        results = process_data(ticker, label_names if label_names or metric_names else None,
+                               (date_from, date_to) if date_from or date_to else None, metric_names, as_of)
+        if 'error' in results:
+            return results, False
+
+        modes = ('annual', 'quarterly') if period == 'both' else (period,)
+        return {mode: filter_annual_quarterly(results, mode) for mode in modes}, True
+    return company_json_response(ticker, compute)
+
+SCREEN_FILTER_PATTERN = re.compile(r'(\w+)@([\w-]+)(>=|<=|!=|>|<|=)(.+)$')
+SCREEN_COMPARISONS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+                      '=': np.equal, '!=': np.not_equal}
+
+def parse_screen_key(text):
+    """Parse 'Label@period' into a (label, period) key, or return None."""
+    label, _, period = text.partition('@')
+    if (label in LABELS_SETS or label in DERIVED_METRICS) and period:
+        return label, period
+    return None
+
+@app.route('/screen', methods=['GET'])
+def screen():
+    """Filter, sort and paginate every cached company on KPIs of a given period.
+
+    Columns are named Label@period, the period being a fiscal year (2022), a calendar quarter
+    (2023-Q4), latest-annual or latest-quarterly. filter= can be repeated, e.g.
+    filter=NetMargin@2022>0.1, and sort= orders by a column, descending unless order=asc."""
+    filters = []
+    for text in request.args.getlist('filter'):
+        match = SCREEN_FILTER_PATTERN.match(text)
+        key = parse_screen_key(f"{match.group(1)}@{match.group(2)}") if match else None
+        try:
+            threshold = float(match.group(4)) if match else None
+        except ValueError:
+            threshold = None
+        if key is None or threshold is None or np.isnan(threshold):
+            return jsonify({'error': f"Invalid filter: {text}, expected Label@period>number"}), 400
+        filters.append((key, SCREEN_COMPARISONS[match.group(3)], threshold))
+
+    sort = None
+    if 'sort' in request.args:
+        sort = parse_screen_key(request.args['sort'])
+        if sort is None:
+            return jsonify({'error': f"Invalid sort: {request.args['sort']}, expected Label@period"}), 400
+    if not filters and sort is None:
+        return jsonify({'error': 'At least one filter or a sort column must be provided'}), 400
+
+    offset = max(request.args.get('offset', default=0, type=int), 0)
+    limit = min(max(request.args.get('limit', default=SCREEN_DEFAULT_LIMIT, type=int), 0), SCREEN_MAX_LIMIT)
+    total, page = get_screen_index().screen(filters, sort, request.args.get('order', default='desc') != 'asc',
+                                            offset, limit)
+    return jsonify({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'results': [{'cik': cik, 'ticker': cik_to_ticker(cik), 'title': cik_to_title(cik),
+                     'values': {f"{label}@{period}": value for (label, period), value in values.items()}}
+                    for cik, values in page]
+    })
+
+def get_batch_arguments():
+    """Read the symbols and label set names of a batch request, returning (symbols, label_names, error).
+
+    They come from a JSON object body {"tickers": [...], "labels": [...]}, where either may also be
+    a comma-separated string like the query arguments, or else from the tickers= and labels=
+    arguments. error is an error message for a malformed body, None otherwise."""
+    body = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        return None, None, 'The request body must be a JSON object'
+    arguments = []
+    for name in ('tickers', 'labels'):
+        values = body.get(name) or request.args.get(name, default='', type=str)
+        if isinstance(values, str):
+            values = values.split(',')
+        if not isinstance(values, list):
+            return None, None, f"{name} must be a list or a comma-separated string"
+        arguments.append(list(dict.fromkeys(str(value).strip() for value in values if str(value).strip())))
+    return arguments[0], arguments[1], None
+
+@app.route('/process_batch', methods=['GET', 'POST'])
+def process_batch():
+    """Stream KPIs for many tickers or CIKs as newline-delimited JSON, one line per symbol as it completes.
+
+    Symbols and labels are read from the tickers= and labels= arguments, or from a JSON body
+    {"tickers": [...], "labels": [...]}. A failing symbol yields a line with an error instead."""
+    symbols, label_names, error = get_batch_arguments()
+    if error is not None:
+        return jsonify({'error': error})
+    if not symbols:
+        return jsonify({'error': 'No ticker symbols provided'})
+    if len(symbols) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} tickers can be processed per batch'})
+    unknown_labels = [label for label in label_names if label not in LABELS_SETS]
+    if unknown_labels:
+        return jsonify({'error': f"Unknown labels: {', '.join(unknown_labels)}"})
+
+    def generate():
+        for symbol, cik, result in process_batch_data(symbols, label_names or None):
+            yield json.dumps({'ticker': symbol, 'cik': cik, **result}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/export', methods=['GET', 'POST'])
+def export():
+    """Stream KPIs for many tickers or CIKs as a long table of (ticker, cik, label, period_type, period_key, value).
+
+    format= is csv (the default), arrow for an Arrow IPC stream or parquet. Symbols and labels
+    are read as for /process_batch, without its size limit, since companies are streamed out
+    as they are processed, and the format may be given in the body too."""
+    symbols, label_names, error = get_batch_arguments()
+    if error is not None:
+        return jsonify({'error': error})
+    body = request.get_json(silent=True) or {}
+    export_format = body.get('format') or request.args.get('format', default='csv', type=str)
+
+    if not symbols:
+        return jsonify({'error': 'No ticker symbols provided'})
+    unknown_labels = [label for label in label_names if label not in LABELS_SETS]
+    if unknown_labels:
+        return jsonify({'error': f"Unknown labels: {', '.join(unknown_labels)}"})
+    if not isinstance(export_format, str) or export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"})
+    if export_format != 'csv' and pyarrow is None:
+        return jsonify({'error': f'format={export_format} requires pyarrow'})
+
+    extension = 'arrows' if export_format == 'arrow' else export_format
+    return Response(stream_with_context(export_data(symbols, label_names or None, export_format)),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename=kpis.{extension}'})
 
 def filter_annual_quarterly(data, mode):
     filtered_data = {}
@@ -543,55 +2099,814 @@ def filter_annual_quarterly(data, mode):
     return filtered_data
 
 
-def process_data(ticker):
+def filter_date_range(formatted_data, date_range):
+    """Keep the periods of a format_data result that fall within a (from, to) pair of dates, either may be None."""
+    date_from, date_to = date_range
+    key_from = date_from.isoformat() if date_from else ''
+    key_to = date_to.isoformat() if date_to else '9999-12-31'
+    year_from = str(date_from.year) if date_from else ''
+    year_to = str(date_to.year) if date_to else '9999'
+    filtered_data = {}
+    for key, value in formatted_data.items():
+        if '-' in key:
+            if key_from <= key <= key_to:
+                filtered_data[key] = value
+        elif year_from <= key <= year_to:
+            filtered_data[key] = value
+    return filtered_data
+
+def process_data(ticker, label_names=None, date_range=None, metric_names=None, as_of=None):
+    """KPIs for a ticker, restricted to label_names and to a (from, to) date_range when given.
+
+    metric_names adds DERIVED_METRICS, computed from the label sets they need whether or not
+    those are returned too. With an as_of date, the KPIs are those known on that date (see
+    process_company_data_as_of)."""
     if not ticker:
         return {'error': 'No ticker symbol provided'}
 
+    requested_labels = label_names
+    processing_range = date_range
+    if metric_names:
+        if label_names is not None:
+            label_names = list(dict.fromkeys([*label_names, *metric_label_sets(metric_names)]))
+        if date_range is not None:
+            # Growth needs the year before the range, which the range margin covers, but a split
+            # adjustment depends on every later split
+            processing_range = (date_range[0], None)
+
     cik = ticker_to_cik(ticker)
     if not cik:
         return {'error': 'Unable to find CIK for the provided ticker'}
 
-    data = get_data_from_cik(cik)
-
-    labels_sets = {
-        'Revenues': (["Revenues", "RevenueFromContractWithCustomerExcludingAssessedTax", "SalesRevenueNet", 
-                    "OtherSalesRevenueNet", "RevenueFromContractWithCustomerIncludingAssessedTax", "SalesRevenueGoodsNet"], "USD"),
-        'Cost': (["CostOfGoodsAndServicesSold", "CostOfGoodsSold", "CostOfRevenue", 
-                 "CostOfGoodsAndServiceExcludingDepreciationDepletionAndAmortization", "CommunicationsAndInformationTechnology"], "USD"),
-        'OpEx': (["OperatingExpenses", "CostsAndExpenses"],"USD"),
-        'SGA': (["SellingGeneralAndAdministrativeExpense","GeneralAndAdministrativeExpense"],"USD"),
-        'Marketing': (["MarketingExpense","SellingAndMarketingExpense"],"USD"),
-        'Research': (["ResearchAndDevelopmentExpense"],"USD"),
-        'OpIncome': (["OperatingIncomeLoss","IncomeLossFromContinuingOperations"],"USD"),
-        'NonOpExpense': (["NonoperatingIncomeExpense","OtherNonoperatingIncomeExpense","InterestIncomeExpenseNonoperatingNet"],"USD"),
-        'IncomeBeforeTax': (["IncomeLossFromContinuingOperationsBeforeIncomeTaxesExtraordinaryItemsNoncontrollingInterest","IncomeLossFromContinuingOperationsBeforeIncomeTaxesMinorityInterestAndIncomeLossFromEquityMethodInvestments"],"USD"),
-        'IncomeTaxExpenseBenefit': (["IncomeTaxExpenseBenefit"],"USD"),
-        'NetIncome': (["NetIncomeLoss", "ProfitLoss"],"USD"),
-        'BasicSharesOut': (["WeightedAverageNumberOfSharesOutstandingBasic","CommonStockSharesOutstanding"],"shares"),
-        'DilutedSharesOut': (["WeightedAverageNumberOfDilutedSharesOutstanding","CommonStockSharesOutstanding"],"shares"),
-        'DividendPerShare': (["CommonStockDividendsPerShareDeclared","CommonStockDividendsPerShareCashPaid"],"USD/shares"),
-        'SplitCoef': (["StockholdersEquityNoteStockSplitConversionRatio1"],"pure"),
-        'EPS': (["EarningsPerShareBasic","IncomeLossFromContinuingOperationsPerBasicShare","IncomeLossFromContinuingOperationsPerBasicAndDilutedShare"],"USD/shares")
-    }
+    # Serve the memoized result straight away while the raw cache file may be served
+    version, state = get_cache_status(cik)
+    formatted_data = get_processed_data(cik, version, label_names) if state != 'expired' and as_of is None else None
+    if formatted_data is not None:
+        get_cache_index().count('processed_hits', cik=cik)
+        if state == 'stale':
+            schedule_refresh(cik)
+
+    if formatted_data is None:
+        data = get_data_from_cik(cik)
+        if data is None:
+            return {'error': 'Unable to retrieve data for the provided ticker'}
+
+        version = get_data_version(cik, data)
+        if as_of is not None:
+            formatted_data = process_company_data_as_of(cik, version, data, label_names, as_of)
+        else:
+            formatted_data = get_processed_data(cik, version, label_names)
 
-    all_extracted_data = {}
-    for label_name, (labels, expected_unit) in labels_sets.items():
-        extracted_data = extract_and_sum_data_from_labels(data, labels, expected_unit)
-        all_extracted_data[label_name] = extracted_data
+    if formatted_data is None:
+        if processing_range is not None:
+            # Range queries only process the facts near the range, so they are not memoized
+            formatted_data = process_company_data(data, label_names, processing_range)
+        else:
+            formatted_data = process_company_data_incrementally(cik, data, label_names)
+            cache_processed_data(cik, version, formatted_data)
+
+    if metric_names:
+        formatted_data = {
+            **(formatted_data if requested_labels is None else {label_name: formatted_data[label_name] for label_name in requested_labels}),
+            **compute_derived_metrics(formatted_data, metric_names)
+        }
+
+    if date_range is not None:
+        return {label_name: filter_date_range(values, date_range) for label_name, values in formatted_data.items()}
+    return formatted_data
+
+
+MAX_BATCH_SIZE = 1000
+BATCH_FETCH_WORKERS = 8  # concurrent SEC downloads
+BATCH_PROCESS_WORKERS = os.cpu_count()  # concurrent pipeline runs
+BATCH_RESULT_TIMEOUT = 300  # seconds without any company completing before the pending ones are given up
+# Module settings a batch worker takes from the process submitting to it, which may have changed them since import
+BATCH_WORKER_SETTINGS = ('CACHE_DIR', 'PROCESSED_CACHE_DIR', 'SERIES_CACHE_DIR', 'CACHE_COMPRESSION')
+
+_batch_executors = {}
+_batch_executors_lock = threading.Lock()
+
+def get_batch_executors():
+    """Lazily create the thread pool used for fetches and the process pool used for the pipeline.
+
+    Pipeline workers are started by a fork server: forking the multi-threaded server directly
+    could copy a lock held by another thread at that moment, which the worker would wait on forever."""
+    with _batch_executors_lock:
+        if not _batch_executors:
+            _batch_executors['fetch'] = ThreadPoolExecutor(max_workers=BATCH_FETCH_WORKERS)
+            _batch_executors['process'] = ProcessPoolExecutor(max_workers=BATCH_PROCESS_WORKERS,
+                                                              mp_context=multiprocessing.get_context('forkserver'))
+            # Shut down before exiting, or the resource tracker reports the pool's semaphores as leaked
+            atexit.register(shutdown_batch_executors)
+        return _batch_executors['fetch'], _batch_executors['process']
+
+def shutdown_batch_executors():
+    with _batch_executors_lock:
+        executors = list(_batch_executors.values())
+        _batch_executors.clear()
+    for executor in executors:
+        executor.shutdown(cancel_futures=True)
+
+def process_cached_company(cik, label_names=None, settings=None):
+    """Process pool entry point: run the pipeline over the cached companyfacts payload of a CIK.
+
+    settings are the BATCH_WORKER_SETTINGS of the submitting process. Returns the source version
+    of the payload processed along with the result."""
+    globals().update(settings or {})
+    # Stale entries are refreshed by the parent process, so the cache file is used whatever its age
+    data = load_cached_data(cache_path(cik)) or get_data_from_cik(cik)
+    if data is None:
+        raise LookupError('Unable to retrieve data for the provided ticker')
+    return get_data_version(cik, data), process_company_data_incrementally(cik, data, label_names)
+
+def process_batch_data(symbols, label_names=None):
+    """Process many tickers or CIKs concurrently, yielding (symbol, cik, result) as each one finishes.
+
+    Stale or missing companyfacts are fetched on a thread pool, and the CPU-bound pipeline runs
+    on a process pool. result holds either the KPIs under 'data' or an 'error' message."""
+    fetch_executor, process_executor = get_batch_executors()
+    # Every pending symbol puts exactly one result or error here, or the loop below gives up on it after a timeout
+    completed = queue.Queue()
+    pending = []
+
+    def fail(symbol, cik, error):
+        completed.put((symbol, cik, {'error': str(error) or type(error).__name__}))
+
+    def finish(symbol, cik, future):
+        try:
+            # The version of the facts processed, a refresh may have replaced the ones seen when submitting
+            version, formatted_data = future.result()
+        except Exception as error:
+            fail(symbol, cik, error)
+            return
+        try:
+            cache_processed_data(cik, version, formatted_data)
+        except Exception as error:
+            print(f"Error: Failed to cache the KPIs of {cik}: {error}")
+        completed.put((symbol, cik, {'data': formatted_data}))
+
+    def submit_processing(symbol, cik):
+        version = get_source_version(cik)
+        formatted_data = get_processed_data(cik, version, label_names)
+        if formatted_data is not None:
+            completed.put((symbol, cik, {'data': formatted_data}))
+            return
+        future = process_executor.submit(process_cached_company, cik, label_names,
+                                         {name: globals()[name] for name in BATCH_WORKER_SETTINGS})
+        future.add_done_callback(lambda future: finish(symbol, cik, future))
+
+    def fetched(symbol, cik, future):
+        try:
+            if future.result() is None:
+                raise LookupError('Unable to retrieve data for the provided ticker')
+            submit_processing(symbol, cik)
+        except Exception as error:
+            fail(symbol, cik, error)
+
+    for symbol in symbols:
+        cik = resolve_cik(symbol)
+        if not cik:
+            yield symbol, None, {'error': 'Unable to find CIK for the provided ticker'}
+            continue
 
-    print(all_extracted_data)
-    deduplicated_data = {label_name: deduplicate_data(values) for label_name, values in all_extracted_data.items()}
-    #print(deduplicated_data)
-    print({label_name: format_data(values) for label_name, values in deduplicated_data.items()})
+        pending.append((symbol, cik))
+        try:
+            version, state = get_cache_status(cik)
+            if state != 'expired':
+                get_cache_index().count('hits' if state == 'fresh' else 'stale_hits', cik=cik)
+                if state == 'stale':
+                    schedule_refresh(cik)
+                submit_processing(symbol, cik)
+            else:
+                future = fetch_executor.submit(get_data_from_cik, cik)
+                future.add_done_callback(lambda future, symbol=symbol, cik=cik: fetched(symbol, cik, future))
+        except Exception as error:
+            fail(symbol, cik, error)
+
+    while pending:
+        try:
+            symbol, cik, result = completed.get(timeout=BATCH_RESULT_TIMEOUT)
+        except queue.Empty:
+            # A worker is stuck, what it may still complete is left in the queue
+            for symbol, cik in pending:
+                yield symbol, cik, {'error': 'Timed out processing the provided ticker'}
+            return
+        pending.remove((symbol, cik))
+        yield symbol, cik, result
+
+EXPORT_CHUNK_SIZE = 64  # companies processed at once while exporting, which bounds memory
+EXPORT_COLUMNS = ('ticker', 'cik', 'label', 'period_type', 'period_key', 'value')
+EXPORT_FORMATS = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream',
+                  'parquet': 'application/vnd.apache.parquet'}
+
+def export_rows(ticker, cik, formatted_data):
+    """Flatten the KPIs of a company into long-format rows in the order of EXPORT_COLUMNS."""
+    for label, periods in formatted_data.items():
+        for key, value in periods.items():
+            yield ticker, cik, label, 'quarterly' if '-' in key else 'annual', key, value
+
+class ExportSink:
+    """Write-only file object pyarrow writers stream into, handing out what was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_schema():
+    return pyarrow.schema([('ticker', pyarrow.string()), ('cik', pyarrow.string()), ('label', pyarrow.string()),
+                           ('period_type', pyarrow.string()), ('period_key', pyarrow.string()),
+                           ('value', pyarrow.float64())])
+
+def export_table(rows):
+    schema = export_schema()
+    return pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(zip(*rows), schema)],
+                                     schema=schema)
+
+def export_data(symbols, label_names=None, export_format='csv'):
+    """Stream the KPIs of many tickers or CIKs as a long table, yielding bytes as each company completes.
+
+    csv is written with a header row, arrow as an Arrow IPC stream with a record batch per company
+    and parquet with a row group per company. Companies are processed EXPORT_CHUNK_SIZE at a time
+    through process_batch_data, and those that fail are left out."""
+    sink = ExportSink()
+    if export_format == 'arrow':
+        writer = pyarrow.ipc.new_stream(sink, export_schema())
+    elif export_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, export_schema())
+    else:
+        text = io.StringIO()
+        csv_writer = csv.writer(text, lineterminator='\n')
+        csv_writer.writerow(EXPORT_COLUMNS)
+        yield text.getvalue().encode()
+
+    for start in range(0, len(symbols), EXPORT_CHUNK_SIZE):
+        for symbol, cik, result in process_batch_data(symbols[start:start + EXPORT_CHUNK_SIZE], label_names):
+            if 'error' in result:
+                print(f"Error: Failed to export {symbol}: {result['error']}")
+                continue
+            rows = list(export_rows(cik_to_ticker(cik) or symbol, cik, result['data']))
+            if not rows:
+                continue
+            if export_format == 'csv':
+                text.seek(0)
+                text.truncate()
+                csv_writer.writerows(rows)
+                yield text.getvalue().encode()
+            else:
+                writer.write_table(export_table(rows))
+                yield sink.drain()
+
+    if export_format != 'csv':
+        writer.close()
+        yield sink.drain()
+
+
+# Concepts are us-gaap ones unless qualified with their namespace, ifrs-full ones for foreign private
+# issuers filing under IFRS. Within a label set, earlier concepts take precedence over later ones.
+# Facts are only read in the label set's unit, amounts aren't converted between currencies, so the
+# monetary label sets of an IFRS filer reporting in euros, say, stay empty.
+DEFAULT_LABELS_SETS = {
+    'Revenues': (["Revenues", "RevenueFromContractWithCustomerExcludingAssessedTax", "SalesRevenueNet", 
+                "OtherSalesRevenueNet", "RevenueFromContractWithCustomerIncludingAssessedTax", "SalesRevenueGoodsNet",
+                "ifrs-full:Revenue", "ifrs-full:RevenueFromContractsWithCustomers"], "USD"),
+    'Cost': (["CostOfGoodsAndServicesSold", "CostOfGoodsSold", "CostOfRevenue", 
+             "CostOfGoodsAndServiceExcludingDepreciationDepletionAndAmortization", "CommunicationsAndInformationTechnology",
+             "ifrs-full:CostOfSales"], "USD"),
+    'OpEx': (["OperatingExpenses", "CostsAndExpenses"],"USD"),
+    'SGA': (["SellingGeneralAndAdministrativeExpense","GeneralAndAdministrativeExpense",
+             "ifrs-full:SellingGeneralAndAdministrativeExpense","ifrs-full:AdministrativeExpense"],"USD"),
+    'Marketing': (["MarketingExpense","SellingAndMarketingExpense","ifrs-full:SellingExpense"],"USD"),
+    'Research': (["ResearchAndDevelopmentExpense","ifrs-full:ResearchAndDevelopmentExpense"],"USD"),
+    'OpIncome': (["OperatingIncomeLoss","IncomeLossFromContinuingOperations","ifrs-full:ProfitLossFromOperatingActivities"],"USD"),
+    'NonOpExpense': (["NonoperatingIncomeExpense","OtherNonoperatingIncomeExpense","InterestIncomeExpenseNonoperatingNet",
+                      "ifrs-full:FinanceIncomeCost"],"USD"),
+    'IncomeBeforeTax': (["IncomeLossFromContinuingOperationsBeforeIncomeTaxesExtraordinaryItemsNoncontrollingInterest","IncomeLossFromContinuingOperationsBeforeIncomeTaxesMinorityInterestAndIncomeLossFromEquityMethodInvestments",
+                         "ifrs-full:ProfitLossBeforeTax"],"USD"),
+    'IncomeTaxExpenseBenefit': (["IncomeTaxExpenseBenefit","ifrs-full:IncomeTaxExpenseContinuingOperations"],"USD"),
+    'NetIncome': (["NetIncomeLoss", "ProfitLoss", "ifrs-full:ProfitLossAttributableToOwnersOfParent", "ifrs-full:ProfitLoss"],"USD"),
+    'BasicSharesOut': (["WeightedAverageNumberOfSharesOutstandingBasic","CommonStockSharesOutstanding","ifrs-full:WeightedAverageShares"],"shares"),
+    'DilutedSharesOut': (["WeightedAverageNumberOfDilutedSharesOutstanding","CommonStockSharesOutstanding","ifrs-full:AdjustedWeightedAverageShares"],"shares"),
+    'DividendPerShare': (["CommonStockDividendsPerShareDeclared","CommonStockDividendsPerShareCashPaid",
+                          "ifrs-full:DividendsRecognisedAsDistributionsToOwnersPerShare"],"USD/shares"),
+    'SplitCoef': (["StockholdersEquityNoteStockSplitConversionRatio1"],"pure"),
+    'EPS': (["EarningsPerShareBasic","IncomeLossFromContinuingOperationsPerBasicShare","IncomeLossFromContinuingOperationsPerBasicAndDilutedShare",
+             "ifrs-full:BasicEarningsLossPerShare"],"USD/shares")
+}
+
+# JSON file replacing DEFAULT_LABELS_SETS when it exists, {"label set": [["concept", "ifrs-full:Concept", "dei:Concept"], "unit"]}
+KPI_MAPPING_FILE = "kpi_mapping.json"
+
+def load_label_sets(path=KPI_MAPPING_FILE, default=DEFAULT_LABELS_SETS):
+    """Read the label sets of a mapping file, or return default if there is none.
+
+    The mapping must define every label set DERIVED_METRICS reads. Nested lists of concepts,
+    which extract_and_sum_data_from_labels once meant to sum, are rejected."""
+    if not os.path.exists(path):
+        return default
+    label_sets = {}
+    for label_name, (labels, expected_unit) in load_data_from_file(path).items():
+        if not labels or not all(isinstance(label, str) for label in labels):
+            raise ValueError(f"{path}: the concepts of {label_name} must be a non-empty list of names, "
+                             f"summed (nested) concept lists aren't supported")
+        label_sets[label_name] = (labels, expected_unit)
+    missing = sorted({name for _, inputs in DERIVED_METRICS.values() for name in inputs
+                      if name not in label_sets and name not in DERIVED_METRICS})
+    if missing:
+        raise ValueError(f"{path}: the label sets {', '.join(missing)} read by DERIVED_METRICS are missing")
+    return label_sets
+
+# Metrics derived from the label sets above, or from other derived metrics: (operation, inputs),
+# operation naming an entry of DERIVED_OPERATIONS applied to the input series in order.
+DERIVED_METRICS = {
+    'GrossProfit': ('difference', ['Revenues', 'Cost']),
+    'GrossMargin': ('ratio', ['GrossProfit', 'Revenues']),
+    'OperatingMargin': ('ratio', ['OpIncome', 'Revenues']),
+    'NetMargin': ('ratio', ['NetIncome', 'Revenues']),
+    'EffectiveTaxRate': ('ratio', ['IncomeTaxExpenseBenefit', 'IncomeBeforeTax']),
+    'RevenueGrowthYoY': ('yoy_growth', ['Revenues']),
+    'RevenueGrowthQoQ': ('qoq_growth', ['Revenues']),
+    'NetIncomeGrowthYoY': ('yoy_growth', ['NetIncome']),
+    'EPSGrowthYoY': ('yoy_growth', ['EPS']),
+    'RevenueTTM': ('ttm', ['Revenues']),
+    'NetIncomeTTM': ('ttm', ['NetIncome']),
+    'RevenuePerShare': ('ratio', ['Revenues', 'DilutedSharesOut']),
+    'DilutedEPS': ('ratio', ['NetIncome', 'DilutedSharesOut']),
+    'SplitAdjustedEPS': ('split_adjusted', ['EPS', 'SplitCoef']),
+    'SplitAdjustedDividendPerShare': ('split_adjusted', ['DividendPerShare', 'SplitCoef'])
+}
+
+LABELS_SETS = load_label_sets()
+EXTRACTION_PLAN = ExtractionPlan(LABELS_SETS)
+
+# A series split into its annual and quarterly periods, each a (periods, values) pair of sorted
+# NumPy arrays: fiscal years for annual periods, day ordinals of their end for quarterly ones.
+# integral tells whether the values were all ints, which sums and differences keep.
+PeriodSeries = namedtuple('PeriodSeries', ['annual', 'quarterly', 'integral'])
+
+QUARTER_OFFSET = 91  # days between the ends of consecutive quarters
+QUARTER_TOLERANCE = 11  # is_valid_period accepts quarters of 80 to 100 days
+YEAR_OFFSET = 365
+YEAR_TOLERANCE = 15  # 52/53-week fiscal years end up to a week off the calendar date
+
+def to_period_series(formatted):
+    """Convert a format_data dict into a PeriodSeries."""
+    annual = sorted((int(key), value) for key, value in formatted.items() if '-' not in key)
+    quarterly = sorted((parse_ordinal(key), value) for key, value in formatted.items() if '-' in key)
+    return PeriodSeries(*(
+        (np.array([period for period, _ in part], dtype=np.int64), np.array([value for _, value in part], dtype=np.float64))
+        for part in (annual, quarterly)
+    ), integral=all(isinstance(value, int) for value in formatted.values()))
+
+def format_period_series(series):
+    """Convert a PeriodSeries back into a format_data dict, leaving out undefined values."""
+    formatted = {}
+    for part, format_period in ((series.annual, str), (series.quarterly, format_ordinal)):
+        periods, values = part
+        finite = np.isfinite(values)
+        values = values[finite].round().astype(np.int64) if series.integral else values[finite]
+        for period, value in zip(periods[finite].tolist(), values.tolist()):
+            formatted[format_period(period)] = value
+    return formatted
+
+def align(*parts):
+    """Align (periods, values) pairs on the union of their periods, with NaN for missing values."""
+    periods = reduce(np.union1d, [part[0] for part in parts])
+    columns = []
+    for part_periods, values in parts:
+        column = np.full(len(periods), np.nan)
+        column[np.searchsorted(periods, part_periods)] = values
+        columns.append(column)
+    return periods, columns
+
+def lagged(periods, values, offset, tolerance):
+    """The value of the period about offset before each period (within tolerance), NaN if there is none."""
+    if not len(periods):
+        return values
+    target = periods - offset
+    index = np.minimum(np.searchsorted(periods, target - tolerance), len(periods) - 1)
+    return np.where(np.abs(periods[index] - target) <= tolerance, values[index], np.nan)
+
+def year_end_ordinals(years):
+    """Annual periods are taken to end on December 31 of their year where a date is needed."""
+    return np.array([datetime.date(year, 12, 31).toordinal() for year in years.tolist()], dtype=np.int64)
+
+def undefined(part):
+    """A part with the periods of the given one and no values."""
+    return part[0], np.full(len(part[0]), np.nan)
+
+def growth(values, previous):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - previous) / np.abs(previous)
+
+def derive_difference(minuend, subtrahend):
+    parts = []
+    for a, b in zip(minuend[:2], subtrahend[:2]):
+        periods, (a_values, b_values) = align(a, b)
+        parts.append((periods, a_values - b_values))
+    return PeriodSeries(*parts, integral=minuend.integral and subtrahend.integral)
+
+def derive_ratio(numerator, denominator):
+    parts = []
+    for a, b in zip(numerator[:2], denominator[:2]):
+        periods, (a_values, b_values) = align(a, b)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            parts.append((periods, a_values / b_values))
+    return PeriodSeries(*parts, integral=False)
+
+def derive_yoy_growth(series):
+    """Growth over the same period a year before, for fiscal years and quarters."""
+    (years, annual), (ends, quarterly) = series.annual, series.quarterly
+    return PeriodSeries((years, growth(annual, lagged(years, annual, 1, 0))),
+                        (ends, growth(quarterly, lagged(ends, quarterly, YEAR_OFFSET, YEAR_TOLERANCE))), integral=False)
+
+def derive_qoq_growth(series):
+    """Growth over the previous quarter, quarters only."""
+    ends, quarterly = series.quarterly
+    return PeriodSeries(undefined(series.annual),
+                        (ends, growth(quarterly, lagged(ends, quarterly, QUARTER_OFFSET, QUARTER_TOLERANCE))), integral=False)
+
+def derive_ttm(series):
+    """Trailing twelve months: the sum of each quarter and the three before it, when none is missing."""
+    ends, quarterly = series.quarterly
+    ttm = np.full(len(ends), np.nan)
+    if len(ends) >= 4:
+        sums = np.concatenate(([0], np.cumsum(quarterly)))
+        span = ends[3:] - ends[:-3]
+        consecutive = np.abs(span - 3 * QUARTER_OFFSET) <= 3 * QUARTER_TOLERANCE
+        ttm[3:] = np.where(consecutive, sums[4:] - sums[:-4], np.nan)
+    return PeriodSeries(undefined(series.annual), (ends, ttm), integral=series.integral)
+
+def derive_split_adjusted(series, split_ratios):
+    """Divide per-share values by the ratios of every split after their period, so they compare with today's shares.
+
+    A split is reported again in later filings, so ratios repeating within a year count as a single split."""
+    events = sorted(zip([*year_end_ordinals(split_ratios.annual[0]).tolist(), *split_ratios.quarterly[0].tolist()],
+                        [*split_ratios.annual[1].tolist(), *split_ratios.quarterly[1].tolist()]))
+    dates, ratios = [], []
+    for date, ratio in events:
+        if ratio > 0 and not (dates and ratio == ratios[-1] and date - dates[-1] <= YEAR_OFFSET):
+            dates.append(date)
+            ratios.append(ratio)
+    # Product of the ratios of the splits from each one on, 1 after the last one
+    later_ratios = np.append(np.cumprod(np.array(ratios[::-1], dtype=np.float64))[::-1], 1.0)
+
+    (years, annual), (ends, quarterly) = series.annual, series.quarterly
+    return PeriodSeries((years, annual / later_ratios[np.searchsorted(dates, year_end_ordinals(years), side='right')]),
+                        (ends, quarterly / later_ratios[np.searchsorted(dates, ends, side='right')]), integral=False)
+
+DERIVED_OPERATIONS = {
+    'difference': derive_difference,
+    'ratio': derive_ratio,
+    'yoy_growth': derive_yoy_growth,
+    'qoq_growth': derive_qoq_growth,
+    'ttm': derive_ttm,
+    'split_adjusted': derive_split_adjusted
+}
+
+def metric_label_sets(metric_names):
+    """The label sets the given derived metrics are computed from, directly or through other metrics."""
+    label_names = []
+    pending = list(metric_names)
+    while pending:
+        name = pending.pop()
+        if name in DERIVED_METRICS:
+            pending.extend(DERIVED_METRICS[name][1])
+        elif name not in label_names:
+            label_names.append(name)
+    return label_names
+
+@stage_timer('derive')
+def compute_derived_metrics(formatted_data, metric_names):
+    """Compute the requested DERIVED_METRICS from processed label sets, computing each input series once."""
+    series = {}
+
+    def resolve(name):
+        if name not in series:
+            if name in DERIVED_METRICS:
+                operation, inputs = DERIVED_METRICS[name]
+                series[name] = DERIVED_OPERATIONS[operation](*(resolve(input_name) for input_name in inputs))
+            else:
+                series[name] = to_period_series(formatted_data.get(name, {}))
+        return series[name]
+
+    return {name: format_period_series(resolve(name)) for name in metric_names}
+
+
+SCREEN_DEFAULT_LIMIT = 100
+SCREEN_MAX_LIMIT = 1000
+PROCESSED_FILE_PATTERN = re.compile(r'(\d{10})\.json$')
+
+def screen_periods(periods):
+    """Map the periods of a format_data dict to screen periods: fiscal years stay 'YYYY', quarters are
+    bucketed by the calendar quarter of their end as 'YYYY-Qn', and 'latest-annual' and
+    'latest-quarterly' hold the most recent of each."""
+    screened = {}
+    latest = {}
+    for key, value in sorted(periods.items()):
+        if '-' in key:
+            screened[f"{key[:4]}-Q{(int(key[5:7]) - 1) // 3 + 1}"] = value
+            latest['latest-quarterly'] = value
+        else:
+            screened[key] = value
+            latest['latest-annual'] = value
+    screened.update(latest)
+    return screened
+
+class ScreenIndex:
+    """Processed KPIs of every cached company as one column per (label, period), for cross-sectional screens.
+
+    Columns are filled from the processed cache files, and each screen first rescans the files
+    modified since the previous one, so companies refreshed by any worker are screened with their
+    new figures. A column is held as {row: value} and scanned as a NaN-padded array over all rows,
+    built when it is first screened after a change."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.ciks = []  # row -> cik
+        self.rows = {}  # cik -> row
+        self.columns = defaultdict(dict)  # (label, period) -> {row: value}
+        self.company_columns = {}  # row -> (label, period) keys of the company's values
+        self.arrays = {}  # (label, period) -> float64 array over rows
+        self.mtimes = {}  # cik -> mtime of its processed file when last read
+        self.directory_mtime = None
+
+    def refresh(self):
+        """Read the processed cache files modified since the last refresh, and drop evicted companies."""
+        with self.refresh_lock:
+            self.refresh_files()
+
+    def refresh_files(self):
+        try:
+            directory_mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if directory_mtime == self.directory_mtime:
+            return
+
+        seen = set()
+        for entry in os.scandir(self.directory):
+            match = PROCESSED_FILE_PATTERN.match(entry.name)
+            if match is None:
+                continue
+            cik = match.group(1)
+            seen.add(cik)
+            try:
+                mtime = entry.stat().st_mtime_ns
+                if self.mtimes.get(cik) == mtime:
+                    continue
+                with open(entry.path, "r") as file:
+                    formatted_data = json.load(file)['data']
+            except (OSError, ValueError, KeyError):
+                continue
+            self.update(cik, formatted_data)
+            self.mtimes[cik] = mtime
+        for cik in set(self.mtimes) - seen:
+            self.update(cik, {})
+            del self.mtimes[cik]
+        self.directory_mtime = directory_mtime
+
+    def update(self, cik, formatted_data):
+        """Replace the values of a company by its processed label sets and the derived metrics they allow."""
+        computable = [name for name in DERIVED_METRICS
+                      if all(label_name in formatted_data for label_name in metric_label_sets([name]))]
+        series = {**formatted_data, **compute_derived_metrics(formatted_data, computable)}
+        values = {(label, period): value for label, periods in series.items()
+                  for period, value in screen_periods(periods).items()}
+
+        with self.lock:
+            row = self.rows.get(cik)
+            if row is None:
+                row = self.rows[cik] = len(self.ciks)
+                self.ciks.append(cik)
+            for key in self.company_columns.get(row, ()):
+                self.columns[key].pop(row, None)
+                self.arrays.pop(key, None)
+            for key, value in values.items():
+                self.columns[key][row] = value
+                self.arrays.pop(key, None)
+            self.company_columns[row] = list(values)
+
+    def array(self, key):
+        """The values of a column over all rows, NaN for companies without one. Called with the lock held."""
+        array = self.arrays.get(key)
+        if array is None or len(array) != len(self.ciks):
+            array = np.full(len(self.ciks), np.nan)
+            column = self.columns.get(key, {})
+            array[np.fromiter(column.keys(), dtype=np.int64, count=len(column))] = np.fromiter(
+                column.values(), dtype=np.float64, count=len(column))
+            self.arrays[key] = array
+        return array
+
+    @stage_timer('screen')
+    def screen(self, filters=(), sort=None, descending=True, offset=0, limit=SCREEN_DEFAULT_LIMIT):
+        """Screen every company in one pass over the columns involved.
+
+        filters are (key, comparison, threshold) triples, comparison being a NumPy ufunc such as
+        np.greater, and keys are (label, period) pairs. Companies lacking a filtered or the sort
+        value are left out. Returns the number of matches and a page of (cik, {key: value}) pairs."""
+        self.refresh()
+        keys = list(dict.fromkeys([*(key for key, _, _ in filters), *([sort] if sort else [])]))
+        with self.lock:
+            mask = np.ones(len(self.ciks), dtype=bool)
+            for key, comparison, threshold in filters:
+                values = self.array(key)
+                # Missing values are NaN, which != would otherwise let through
+                mask &= ~np.isnan(values) & comparison(values, threshold)
+            if sort is not None:
+                sort_values = self.array(sort)
+                mask &= ~np.isnan(sort_values)
+            rows = np.flatnonzero(mask)
+
+            if sort is not None:
+                order_values = -sort_values[rows] if descending else sort_values[rows]
+                end = offset + limit
+                if end < len(rows):
+                    # Only the rows up to the end of the page need to be ordered
+                    rows = rows[np.argpartition(order_values, end)[:end]]
+                    order_values = -sort_values[rows] if descending else sort_values[rows]
+                rows = rows[np.argsort(order_values, kind='stable')]
+            page = rows[offset:offset + limit].tolist()
+            return int(mask.sum()), [(self.ciks[row], {key: self.columns[key].get(row) for key in keys}) for row in page]
+
+_screen_index = None
+_screen_index_lock = threading.Lock()
+
+def get_screen_index():
+    global _screen_index
+    with _screen_index_lock:
+        if _screen_index is None or _screen_index.directory != PROCESSED_CACHE_DIR:
+            _screen_index = ScreenIndex(PROCESSED_CACHE_DIR)
+        return _screen_index
+
+# Facts ending this far outside the calendar years of a requested date range can't affect the
+# periods inside it: a fiscal year's quarters all end within a year of its end, and a fiscal year
+# is keyed by the calendar year holding most of its days, so one kept for the range's last year
+# may end up to half a year into the next (a July-June year) and its quarters later still.
+DATE_RANGE_MARGIN_BEFORE = timedelta(days=730)
+DATE_RANGE_MARGIN_AFTER = timedelta(days=366)
+
+def process_company_data(data, label_names=None, date_range=None):
+    """Run the KPI pipeline (extract, deduplicate, fill missing quarters, format) over a companyfacts payload.
+
+    Only the label sets in label_names are processed (all by default). With a (from, to) date_range,
+    facts that can't contribute to periods within it are dropped right after extraction."""
+    end_range = None
+    if date_range is not None:
+        date_from, date_to = date_range
+        # filter_date_range keeps fiscal years by their year, so the margins extend from the range's years
+        end_range = ((datetime.date(date_from.year, 1, 1) - DATE_RANGE_MARGIN_BEFORE).toordinal() if date_from else 1,
+                     (datetime.date(date_to.year, 12, 31) + DATE_RANGE_MARGIN_AFTER).toordinal() if date_to
+                     else datetime.date.max.toordinal())
+
+    with stage_timer('extract'):
+        all_extracted_data = {label_name: [fact for _, fact in ranked_facts] for label_name, ranked_facts in
+                              EXTRACTION_PLAN.extract(data, label_names, end_range).items()}
+
+    with stage_timer('deduplicate'):
+        deduplicated_data = {label_name: deduplicate_data(values) for label_name, values in all_extracted_data.items()}
     #completed_data = {label_name: estimate_missing_quarterly_value(values) for label_name, values in deduplicated_data.items()}
-    completed_data = {label_name: add_missing_quarter_data(values) for label_name, values in deduplicated_data.items()}
-    #print(completed_data)
-    formatted_data = {label_name: format_data(values) for label_name, values in completed_data.items()}
-    #print(formatted_data)
+    with stage_timer('missing_quarters'):
+        completed_data = {label_name: add_missing_quarter_data(values) for label_name, values in deduplicated_data.items()}
+    with stage_timer('format'):
+        formatted_data = {label_name: format_data(values) for label_name, values in completed_data.items()}
     #formatted_data = {label_name: format_data(values) for label_name, values in all_extracted_data.items()}
 
     return formatted_data
 
+def process_company_data_incrementally(cik, data, label_names=None):
+    """Like process_company_data, but only the facts of filings not merged before are processed.
+
+    The deduplicated facts of each label set are persisted per CIK along with the accession numbers
+    they came from, so a refresh that brings a new 10-Q costs about as much as that filing's facts."""
+    series_by_label = load_series(cik)
+    with stage_timer('extract'):
+        for label_name in (LABELS_SETS if label_names is None else label_names):
+            labels, expected_unit = LABELS_SETS[label_name]
+            series = series_by_label.get(label_name)
+            if series is None or series.labels != labels or series.unit != expected_unit:
+                # New label set, or its concepts changed since the series was built
+                series_by_label[label_name] = LabelSeries(labels, expected_unit)
+        new_facts = EXTRACTION_PLAN.extract(data, label_names, known_accns={
+            label_name: series.accns for label_name, series in series_by_label.items()})
+
+    # Only saved if some fact or accession number wasn't merged before, facts without one come back every time
+    modified = False
+    with stage_timer('merge'):
+        for label_name, facts in new_facts.items():
+            if facts:
+                series = series_by_label[label_name]
+                merged = len(series.accns) + len(series.unfiled)
+                series.update_missing_quarters(series.merge(facts))
+                modified = modified or len(series.accns) + len(series.unfiled) != merged
+    with stage_timer('format'):
+        formatted_data = {label_name: format_data(series_by_label[label_name].completed_facts()) for label_name in new_facts}
+
+    if modified:
+        save_series(cik, series_by_label)
+        track_cache_entry(cik)
+    return formatted_data
+
+AS_OF_INDEX_CACHE_SIZE = 32  # companies whose AsOfIndexes are kept in memory
+
+class AsOfIndex:
+    """The facts of one label set grouped by period, with the versions of each period ordered by filing date.
+
+    Periods are ordered by the date their first version was filed, so a query only visits the
+    periods known on its date, and picks the version in effect with a bisection."""
+
+    def __init__(self, ranked_facts):
+        periods = {}  # (start, end, fp) -> {rank: [Fact]}
+        for rank, fact in ranked_facts:
+            if not is_valid_period(fact):
+                continue
+            if fact.start is None:
+                # Instant facts are taken to cover the year up to their date
+                fact = copy.copy(fact)
+                fact.start = fact.end - 365
+            periods.setdefault((fact.start, fact.end, fact.fp), {}).setdefault(rank, []).append(fact)
+
+        entries = []
+        for order, (key, versions_by_rank) in enumerate(periods.items()):
+            versions = []
+            for rank in sorted(versions_by_rank):
+                facts = sorted(versions_by_rank[rank], key=lambda fact: fact.filed or 0)
+                versions.append(([fact.filed or 0 for fact in facts], facts))
+            entries.append((min(filed[0] for filed, _ in versions), order, versions))
+        entries.sort(key=lambda entry: entry[:2])
+        self.first_filed = [first_filed for first_filed, _, _ in entries]
+        # (order of the period's first fact, versions by concept priority), order reproducing deduplicate_data's
+        self.periods = [(order, versions) for _, order, versions in entries]
+
+    def facts_as_of(self, ordinal):
+        """The deduplicated facts known on a day ordinal, sorted like deduplicate_data's result.
+
+        Each period gets the latest version filed by then, from the highest-priority concept reporting it."""
+        known = []
+        for order, versions in self.periods[:bisect_right(self.first_filed, ordinal)]:
+            for filed, facts in versions:
+                index = bisect_right(filed, ordinal)
+                if index:
+                    known.append((facts[index - 1].start, order, facts[index - 1]))
+                    break
+        known.sort(key=lambda entry: entry[:2])
+        return [fact for _, _, fact in known]
+
+# (cik, source version) -> {label set name: AsOfIndex}, least recently used first
+_as_of_indexes = OrderedDict()
+_as_of_indexes_lock = threading.Lock()
+
+@stage_timer('as_of_index')
+def get_as_of_indexes(cik, version, data, label_names):
+    """The AsOfIndexes of a company's label sets, built once per source version and reused by later queries."""
+    with _as_of_indexes_lock:
+        indexes = _as_of_indexes.setdefault((cik, version), {})
+        _as_of_indexes.move_to_end((cik, version))
+        while len(_as_of_indexes) > AS_OF_INDEX_CACHE_SIZE:
+            _as_of_indexes.popitem(last=False)
+    missing = [label_name for label_name in label_names if label_name not in indexes]
+    if missing:
+        for label_name, ranked_facts in EXTRACTION_PLAN.extract(data, missing).items():
+            indexes[label_name] = AsOfIndex(ranked_facts)
+    return {label_name: indexes[label_name] for label_name in label_names}
+
+def process_company_data_as_of(cik, version, data, label_names=None, as_of=None):
+    """Run the pipeline over the facts known on the as_of date.
+
+    Where deduplicate_data keeps the first version of a period, this keeps the latest one filed
+    on or before as_of, so restatements filed by then are taken into account."""
+    label_names = list(LABELS_SETS) if label_names is None else label_names
+    ordinal = as_of.toordinal()
+    indexes = get_as_of_indexes(cik, version, data, label_names)
+    with stage_timer('deduplicate'):
+        deduplicated_data = {label_name: indexes[label_name].facts_as_of(ordinal) for label_name in label_names}
+    with stage_timer('missing_quarters'):
+        completed_data = {label_name: add_missing_quarter_data(values) for label_name, values in deduplicated_data.items()}
+    with stage_timer('format'):
+        return {label_name: format_data(values) for label_name, values in completed_data.items()}
+
 
 if __name__ == "__main__":
     # Check if the cache directory exists, if not, create it
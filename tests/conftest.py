@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Point every server cache at a temporary directory, with the in-memory caches emptied."""
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setattr(server, "CACHE_DIR", cache_dir)
+    monkeypatch.setattr(server, "PROCESSED_CACHE_DIR", os.path.join(cache_dir, "processed"))
+    monkeypatch.setattr(server, "SERIES_CACHE_DIR", os.path.join(cache_dir, "series"))
+    server._processed_cache.clear()
+    server._response_cache.clear()
+    server._as_of_indexes.clear()
+    yield cache_dir
+    server._processed_cache.clear()
+    server._response_cache.clear()
+    server._as_of_indexes.clear()
@@ -0,0 +1,57 @@
+"""KPIs as known on a given date, from process_company_data_as_of."""
+import datetime
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+CIK = "0000320193"
+FY2021 = {'start': '2020-10-01', 'end': '2021-09-30', 'fp': 'FY', 'form': '10-K', 'fy': 2021}
+
+
+def companyfacts(records_by_concept):
+    return {'cik': 320193, 'entityName': "Synthetic Company", 'facts': {'us-gaap': {
+        concept: {'units': {'USD': records}} for concept, records in records_by_concept.items()}}}
+
+
+def revenues_as_of(data, date, version):
+    return server.process_company_data_as_of(CIK, version, data, ['Revenues'],
+                                             datetime.date.fromisoformat(date))['Revenues']
+
+
+@pytest.fixture
+def restated(cache_dir):
+    """The 2021 revenues, restated by the next year's 10-K."""
+    return companyfacts({'Revenues': [
+        {**FY2021, 'val': 100, 'accn': '0000320193-21-000001', 'filed': '2021-11-01'},
+        {**FY2021, 'val': 120, 'accn': '0000320193-22-000001', 'filed': '2022-11-01', 'fy': 2022}]})
+
+
+def test_nothing_is_known_before_the_first_filing(restated):
+    assert revenues_as_of(restated, '2021-10-31', 'restated') == {}
+
+
+def test_restatement_is_known_from_its_filing_date(restated):
+    assert revenues_as_of(restated, '2021-11-01', 'restated') == {'2021': 100}
+    assert revenues_as_of(restated, '2022-10-31', 'restated') == {'2021': 100}
+    assert revenues_as_of(restated, '2022-11-01', 'restated') == {'2021': 120}
+    # Without a date the figure first reported is kept
+    assert server.process_company_data(restated, ['Revenues'])['Revenues'] == {'2021': 100}
+
+
+def test_higher_priority_concept_filed_later_takes_over(cache_dir):
+    data = companyfacts({
+        'Revenues': [{**FY2021, 'val': 100, 'accn': '0000320193-22-000001', 'filed': '2022-02-01'}],
+        'RevenueFromContractWithCustomerExcludingAssessedTax': [
+            {**FY2021, 'val': 90, 'accn': '0000320193-21-000001', 'filed': '2021-11-01'}]})
+    assert revenues_as_of(data, '2021-12-01', 'priority') == {'2021': 90}
+    assert revenues_as_of(data, '2022-02-01', 'priority') == {'2021': 100}
+    assert server.process_company_data(data, ['Revenues'])['Revenues'] == {'2021': 100}
+
+
+def test_far_future_matches_the_full_pipeline(cache_dir):
+    # Comparatives in later filings repeat the figures, so nothing is restated
+    data = generate_companyfacts(years=6, duplicates=2, missing_quarters=0.2)
+    assert (server.process_company_data_as_of(CIK, 'future', data, None, datetime.date(2100, 1, 1)) ==
+            server.process_company_data(data))
@@ -0,0 +1,77 @@
+"""Batch processing through /process_batch."""
+import json
+import os
+from concurrent.futures import Future
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+
+@pytest.fixture
+def client(cache_dir, monkeypatch):
+    # No ticker resolves, each symbol streams back an error line
+    monkeypatch.setattr(server, "resolve_cik", lambda symbol: None)
+    return server.app.test_client()
+
+
+def streamed_tickers(response):
+    return [json.loads(line)['ticker'] for line in response.get_data(as_text=True).splitlines()]
+
+
+@pytest.mark.parametrize("body, tickers", [({"tickers": ["AAPL", "MSFT"]}, ["AAPL", "MSFT"]),
+                                           ({"tickers": "AAPL, MSFT,"}, ["AAPL", "MSFT"]),
+                                           ({"tickers": [320193, " AAPL ", "AAPL"]}, ["320193", "AAPL"])])
+def test_body_tickers(client, body, tickers):
+    assert streamed_tickers(client.post("/process_batch", json=body)) == tickers
+
+
+def test_query_tickers(client):
+    assert streamed_tickers(client.get("/process_batch?tickers=AAPL,,MSFT")) == ["AAPL", "MSFT"]
+
+
+@pytest.mark.parametrize("body", [["AAPL"], "AAPL", {"tickers": 5}, {"tickers": {"AAPL": 1}},
+                                  {"tickers": ["AAPL"], "labels": 5}, {"tickers": ["AAPL"], "labels": ["Unknown"]}, {}])
+def test_malformed_requests(client, body):
+    response = client.post("/process_batch", json=body)
+    assert response.status_code == 200
+    assert 'error' in response.get_json()
+
+
+@pytest.fixture
+def companies(cache_dir, monkeypatch):
+    """Two cached companies, AAA and BBB."""
+    ciks = {"AAA": "0000000001", "BBB": "0000000002"}
+    payloads = {}
+    for seed, (ticker, cik) in enumerate(ciks.items()):
+        payloads[cik] = generate_companyfacts(cik=int(cik), years=3, seed=seed)
+        server.cache_fact_columns(server.cache_path(cik), payloads[cik])
+    monkeypatch.setattr(server, "resolve_cik", lambda symbol: ciks.get(symbol))
+    return payloads
+
+
+def test_batch_is_processed_by_workers(companies):
+    results = {symbol: (cik, result) for symbol, cik, result in
+               server.process_batch_data(["AAA", "NOPE", "BBB"], ["Revenues", "EPS"])}
+    assert results["NOPE"] == (None, {'error': 'Unable to find CIK for the provided ticker'})
+    for symbol in ("AAA", "BBB"):
+        cik, result = results[symbol]
+        assert result == {'data': server.process_company_data(companies[cik], ["Revenues", "EPS"])}
+    # The workers saved the series to the cache directory of this process
+    assert os.path.exists(os.path.join(server.SERIES_CACHE_DIR, "0000000001.json"))
+
+
+class StuckExecutor:
+    def submit(self, *args):
+        return Future()
+
+
+def test_stuck_worker_times_out(companies, monkeypatch):
+    fetch_executor, _ = server.get_batch_executors()
+    monkeypatch.setattr(server, "get_batch_executors", lambda: (fetch_executor, StuckExecutor()))
+    monkeypatch.setattr(server, "BATCH_RESULT_TIMEOUT", 0.1)
+    assert list(server.process_batch_data(["AAA", "NOPE", "BBB"])) == [
+        ("NOPE", None, {'error': 'Unable to find CIK for the provided ticker'}),
+        ("AAA", "0000000001", {'error': 'Timed out processing the provided ticker'}),
+        ("BBB", "0000000002", {'error': 'Timed out processing the provided ticker'})]
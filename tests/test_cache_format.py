@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+
+def fact_tuple(fact):
+    return tuple(getattr(fact, name) for name in server.Fact.__slots__)
+
+
+@pytest.fixture
+def data():
+    document = generate_companyfacts(years=8, extra_concepts=5, seed=2)
+    # A float value, a record without accn and an instant fact without start exercise the column encodings
+    records = document['facts']['us-gaap']['Revenues']['units']['USD']
+    records[0]['val'] = 1234.5
+    del records[1]['accn']
+    del records[2]['start']
+    return server.parse_companyfacts(json.dumps(document))
+
+
+@pytest.mark.parametrize("compression", [None, 'zlib'])
+def test_fact_columns_round_trip(tmp_path, monkeypatch, data, compression):
+    monkeypatch.setattr(server, "CACHE_COMPRESSION", compression)
+    path = str(tmp_path / "0000320193.facts")
+    validators = {'etag': '"abc"', 'last_modified': 'Tue, 01 Oct 2024 00:00:00 GMT'}
+    server.cache_fact_columns(path, data, timestamp=1000.0, soft_ttl=60, hard_ttl=600, validators=validators)
+
+    columns = server.FactColumns(path)
+    assert (columns.cik, columns.entity_name, columns.validators, columns.timestamp) == (data['cik'], data['entityName'], validators, 1000.0)
+    assert columns.covers(server.get_wanted_concepts())
+    for namespace, concepts in server.get_wanted_concepts().items():
+        for concept, units in concepts.items():
+            for unit in units:
+                records = data['facts'][namespace].get(concept, {}).get('units', {}).get(unit, [])
+                facts = columns.materialize(columns.rows(namespace, concept, unit))
+                assert [fact_tuple(fact) for fact in facts] == [fact_tuple(server.Fact.from_record(record)) for record in records]
+                assert [type(fact.val) for fact in facts] == [type(record['val']) for record in records]
+
+
+def test_uncompressed_columns_are_memory_mapped(tmp_path, monkeypatch, data):
+    monkeypatch.setattr(server, "CACHE_COMPRESSION", None)
+    path = str(tmp_path / "0000320193.facts")
+    server.cache_fact_columns(path, data)
+    columns = server.FactColumns(path)
+    assert all(not column.flags.owndata and not column.flags.writeable for column in columns.columns.values())
+
+
+def test_content_hash_ignores_compression_and_timestamp(tmp_path, monkeypatch, data):
+    hashes = []
+    for compression, timestamp in [(None, 1.0), ('zlib', 2.0)]:
+        monkeypatch.setattr(server, "CACHE_COMPRESSION", compression)
+        path = str(tmp_path / f"{compression}.facts")
+        server.cache_fact_columns(path, data, timestamp=timestamp)
+        hashes.append(server.read_cache_prefix(path).content_hash)
+    assert hashes[0] == hashes[1]
+
+
+def test_touch_only_rewrites_the_timestamp(tmp_path, data):
+    path = str(tmp_path / "0000320193.facts")
+    server.cache_fact_columns(path, data, timestamp=1.0, soft_ttl=5, hard_ttl=50)
+    before = server.read_cache_prefix(path)
+    server.touch_cache_file(path, timestamp=9.0)
+    assert server.read_cache_prefix(path) == before._replace(timestamp=9.0)
+
+
+def test_invalid_files_are_not_loaded(tmp_path, data):
+    path = str(tmp_path / "0000320193.facts")
+    assert server.load_cached_data(path) is None
+    with open(path, "wb") as file:
+        file.write(b"not a cache file")
+    assert server.read_cache_prefix(path) is None
+    assert server.load_cached_data(path) is None
+
+
+def test_files_missing_wanted_concepts_are_not_loaded(tmp_path, data):
+    path = str(tmp_path / "0000320193.facts")
+    server.cache_fact_columns(path, data, wanted={'us-gaap': {'Revenues': {'USD'}}})
+    assert os.path.exists(path) and server.load_cached_data(path) is None
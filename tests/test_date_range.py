@@ -0,0 +1,42 @@
+"""Processing restricted to a date range against filtering the result of a full run."""
+import datetime
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+DATE_RANGES = [(None, datetime.date(2019, 1, 1)), (None, datetime.date(2019, 6, 1)), (None, datetime.date(2019, 12, 31)),
+               (datetime.date(2018, 1, 1), None), (datetime.date(2018, 7, 15), None), (datetime.date(2018, 12, 31), None),
+               (datetime.date(2017, 3, 1), datetime.date(2020, 8, 31)), (datetime.date(2019, 1, 1), datetime.date(2019, 12, 31))]
+
+
+@pytest.fixture(scope="module", params=[1, 3, 6, 7, 9, 12])
+def payload(request):
+    """Filings of a company whose fiscal year ends in the given month."""
+    return generate_companyfacts(years=12, fiscal_year_end_month=request.param, missing_quarters=0.2, seed=request.param)
+
+
+@pytest.fixture(scope="module")
+def full_result(payload):
+    return server.process_company_data(payload)
+
+
+def test_range_processing_matches_filtering_the_full_result(payload, full_result):
+    for date_range in DATE_RANGES:
+        result = server.process_company_data(payload, None, date_range)
+        for label_name, values in full_result.items():
+            assert (server.filter_date_range(result[label_name], date_range) ==
+                    server.filter_date_range(values, date_range)), (label_name, date_range)
+
+
+def test_derived_metrics_of_a_range(payload, full_result):
+    metric_names = list(server.DERIVED_METRICS)
+    expected = server.compute_derived_metrics(full_result, metric_names)
+    for date_range in DATE_RANGES:
+        # Growth and split adjustments are processed from the start of the range on, as process_data does
+        result = server.process_company_data(payload, None, (date_range[0], None))
+        derived = server.compute_derived_metrics(result, metric_names)
+        for metric_name in metric_names:
+            assert (server.filter_date_range(derived[metric_name], date_range) ==
+                    server.filter_date_range(expected[metric_name], date_range)), (metric_name, date_range)
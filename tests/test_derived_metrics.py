@@ -0,0 +1,85 @@
+"""DERIVED_METRICS computed from format_data results."""
+import datetime
+
+import server
+
+
+def quarter_ends(first_end, count, skip=()):
+    """Keys of count quarters ending 91 days apart from first_end (ISO), leaving out the positions in skip."""
+    first_end = datetime.date.fromisoformat(first_end)
+    return [(first_end + datetime.timedelta(days=91 * index)).isoformat() for index in range(count) if index not in skip]
+
+
+def derive(formatted_data, metric_name):
+    return server.compute_derived_metrics(formatted_data, [metric_name])[metric_name]
+
+
+def test_difference_and_ratio_align_on_common_periods():
+    formatted_data = {
+        'Revenues': {'2020': 100, '2021': 200, '2022': 400, '2022-03-31': 90, '2022-06-30': 110},
+        'Cost': {'2021': 50, '2022': 100, '2023': 300, '2022-06-30': 55, '2022-09-29': 60}
+    }
+    assert derive(formatted_data, 'GrossProfit') == {'2021': 150, '2022': 300, '2022-06-30': 55}
+    assert derive(formatted_data, 'GrossMargin') == {'2021': 0.75, '2022': 0.75, '2022-06-30': 0.5}
+
+
+def test_division_by_zero_is_dropped():
+    formatted_data = {'Revenues': {'2020': 0, '2021': 0, '2022': 100}, 'NetIncome': {'2020': 10, '2021': 0, '2022': 5}}
+    assert derive(formatted_data, 'NetMargin') == {'2022': 0.05}
+    assert derive(formatted_data, 'RevenueGrowthYoY') == {}
+    assert derive({'Revenues': {'2021': -50, '2022': 50}}, 'RevenueGrowthYoY') == {'2022': 2.0}
+
+
+def test_integral_series_stay_integers():
+    big = 10 ** 12 + 1
+    difference = derive({'Revenues': {'2022': big, '2023': 7}, 'Cost': {'2022': 1, '2023': 2}}, 'GrossProfit')
+    assert difference == {'2022': big - 1, '2023': 5}
+    assert all(type(value) is int for value in difference.values())
+    # A float in either input makes the result a float
+    difference = derive({'Revenues': {'2022': 10.5}, 'Cost': {'2022': 1}}, 'GrossProfit')
+    assert difference == {'2022': 9.5}
+    # Ratios are never integral
+    assert derive({'Revenues': {'2022': 10}, 'Cost': {'2022': 5}}, 'GrossMargin') == {'2022': 0.5}
+
+
+def test_yoy_growth_across_52_and_53_week_years():
+    # A 53-week fiscal year puts a quarter end 371 days after the one of the year before
+    revenues = {'2021-12-25': 100, '2022-12-31': 150, '2023-12-30': 120, '2025-12-27': 240, '2021': 400, '2022': 500}
+    assert derive({'Revenues': revenues}, 'RevenueGrowthYoY') == {
+        '2022': 0.25, '2022-12-31': 0.5, '2023-12-30': -0.2}
+
+
+def test_gap_breaks_quarter_runs():
+    ends = quarter_ends('2020-03-28', 10, skip={5})
+    revenues = {end: 10 * (index + 1) for index, end in enumerate(ends)}
+    ttm = derive({'Revenues': revenues}, 'RevenueTTM')
+    # Four consecutive quarters are needed, the missing sixth one leaves out the next three
+    assert ttm == {ends[3]: 100, ends[4]: 140, ends[8]: 300}
+    assert all(type(value) is int for value in ttm.values())
+    qoq = derive({'Revenues': revenues}, 'RevenueGrowthQoQ')
+    assert set(qoq) == set(ends[1:]) - {ends[5]}
+    assert qoq[ends[1]] == 1.0
+
+
+def test_ttm_and_qoq_leave_out_fiscal_years():
+    revenues = {'2022': 400, **{end: 100 for end in quarter_ends('2022-03-31', 4)}}
+    assert list(derive({'Revenues': revenues}, 'RevenueTTM')) == [quarter_ends('2022-03-31', 4)[3]]
+    assert '2022' not in derive({'Revenues': revenues}, 'RevenueGrowthQoQ')
+
+
+def test_split_adjustment_counts_repeated_ratios_once():
+    formatted_data = {
+        'EPS': {'2019': 8.0, '2020': 4.0, '2021': 2.0, '2023': 1.0, '2021-03-31': 3.0},
+        # A 4:1 split reported in two annual reports, then a 2:1 split reported in a 10-Q
+        'SplitCoef': {'2020': 4, '2021': 4, '2022-09-30': 2}
+    }
+    assert derive(formatted_data, 'SplitAdjustedEPS') == {
+        '2019': 1.0, '2020': 2.0, '2021': 1.0, '2023': 1.0, '2021-03-31': 1.5}
+    # The same ratio reported years apart is a second split
+    formatted_data['SplitCoef'] = {'2018': 2, '2020': 2}
+    assert derive(formatted_data, 'SplitAdjustedEPS')['2019'] == 4.0
+
+
+def test_metrics_of_missing_label_sets_are_empty():
+    assert derive({}, 'GrossMargin') == {}
+    assert derive({'Revenues': {'2022': 100}}, 'SplitAdjustedEPS') == {}
@@ -0,0 +1,93 @@
+"""Cache size accounting and eviction through the CacheIndex."""
+import os
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def small_cache(cache_dir, monkeypatch):
+    """A cache holding three 1000-byte entries."""
+    monkeypatch.setattr(server, "CACHE_MAX_BYTES", 3000)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def write_entry(cik, size=1000):
+    with open(server.cache_path(cik), "wb") as file:
+        file.write(b"\0" * size)
+    server.track_cache_entry(cik)
+    # Keeps the last access times of consecutive entries apart
+    time.sleep(0.01)
+
+
+def access(cik, times=1):
+    for _ in range(times):
+        server.get_cache_index().count('hits', cik=cik)
+    time.sleep(0.01)
+
+
+def cached():
+    return {cik for cik in "ABCDE" if os.path.exists(server.cache_path(cik))}
+
+
+def test_lru_evicts_the_least_recently_used(small_cache, monkeypatch):
+    monkeypatch.setattr(server, "CACHE_EVICTION_POLICY", 'lru')
+    for cik in "ABC":
+        write_entry(cik)
+    access("A")
+    write_entry("D")
+    assert cached() == set("ACD")
+    write_entry("E")
+    assert cached() == set("ADE")
+    assert server.get_cache_index().summary() == (3, 3000)
+    assert server.get_cache_index().counters()['evictions'] == 2
+
+
+def test_lfu_evicts_the_least_used(small_cache, monkeypatch):
+    monkeypatch.setattr(server, "CACHE_EVICTION_POLICY", 'lfu')
+    for cik in "ABC":
+        write_entry(cik)
+    access("A", 2)
+    access("C")
+    write_entry("D")
+    assert cached() == set("ACD")
+    # D was used once since it was written, less than A and C
+    write_entry("E")
+    assert cached() == set("ACE")
+
+
+def test_entry_just_written_is_kept(small_cache):
+    write_entry("A")
+    write_entry("B", 5000)
+    assert cached() == {"B"}
+    assert server.get_cache_index().summary() == (1, 5000)
+    write_entry("C")
+    assert cached() == {"C"}
+
+
+def test_unlimited_cache(small_cache, monkeypatch):
+    monkeypatch.setattr(server, "CACHE_MAX_BYTES", None)
+    for cik in "ABCDE":
+        write_entry(cik)
+    assert cached() == set("ABCDE")
+
+
+def test_admin_cache_rates(small_cache):
+    for cik in "AB":
+        write_entry(cik)
+    index = server.get_cache_index()
+    access("A", 2)
+    index.count('stale_hits', cik="B")
+    index.count('misses')
+    stats = server.app.test_client().get("/admin/cache").get_json()
+    assert stats['entries'] == 2 and stats['size_bytes'] == 2000 and stats['max_bytes'] == 3000
+    assert stats['counters'] == {'hits': 2, 'stale_hits': 1, 'misses': 1}
+    assert stats['hit_rate'] == 0.75 and stats['miss_rate'] == 0.25
+
+
+def test_admin_cache_without_lookups(small_cache):
+    stats = server.app.test_client().get("/admin/cache").get_json()
+    assert stats['hit_rate'] is None and stats['miss_rate'] is None
@@ -0,0 +1,69 @@
+"""Long-format exports through /export."""
+import csv
+import io
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+CIKS = {"AAA": "0000000001", "BBB": "0000000002"}
+LABELS = ["Revenues", "EPS"]
+
+
+@pytest.fixture
+def client(cache_dir):
+    return server.app.test_client()
+
+
+@pytest.mark.parametrize("body", [["AAPL"], {"tickers": 5}, {"tickers": ["AAPL"], "labels": 5},
+                                  {"tickers": ["AAPL"], "format": ["csv"]}, {"tickers": ["AAPL"], "format": "xlsx"},
+                                  {"tickers": ["AAPL"], "labels": ["Unknown"]}, {}])
+def test_malformed_requests(client, body):
+    response = client.post("/export", json=body)
+    assert response.status_code == 200
+    assert 'error' in response.get_json()
+
+
+@pytest.fixture
+def expected_rows(cache_dir, monkeypatch):
+    """The rows of two cached companies, AAA and BBB."""
+    monkeypatch.setattr(server, "resolve_cik", lambda symbol: CIKS.get(symbol))
+    monkeypatch.setattr(server, "cik_to_ticker", lambda cik: None)
+    rows = []
+    for seed, (ticker, cik) in enumerate(CIKS.items()):
+        payload = generate_companyfacts(cik=int(cik), years=3, seed=seed)
+        server.cache_fact_columns(server.cache_path(cik), payload)
+        rows += server.export_rows(ticker, cik, server.process_company_data(payload, LABELS))
+    return sorted((*row[:5], float(row[5])) for row in rows)
+
+
+def export(export_format):
+    response = server.app.test_client().post("/export", json={
+        "tickers": ["AAA", "NOPE", "BBB"], "labels": LABELS, "format": export_format})
+    assert response.status_code == 200
+    assert response.mimetype == server.EXPORT_FORMATS[export_format]
+    return response.get_data()
+
+
+def table_rows(table):
+    assert table.column_names == list(server.EXPORT_COLUMNS)
+    return sorted(tuple(row.values()) for row in table.to_pylist())
+
+
+def test_csv_round_trip(expected_rows):
+    header, *rows = csv.reader(io.StringIO(export("csv").decode()))
+    assert header == list(server.EXPORT_COLUMNS)
+    assert sorted((*row[:5], float(row[5])) for row in rows) == expected_rows
+
+
+def test_arrow_round_trip(expected_rows):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    assert table_rows(pyarrow.ipc.open_stream(export("arrow")).read_all()) == expected_rows
+
+
+def test_parquet_round_trip(expected_rows):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    assert table_rows(pyarrow.parquet.read_table(pyarrow.BufferReader(export("parquet")))) == expected_rows
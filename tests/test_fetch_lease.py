@@ -0,0 +1,49 @@
+"""Cross-process fetch leases of the CacheIndex."""
+import threading
+import time
+
+import server
+
+
+def test_lease_is_exclusive(cache_dir):
+    index = server.get_cache_index()
+    assert index.acquire_lease("fetch:1", "a", 10)
+    assert index.acquire_lease("fetch:1", "a", 10)
+    assert not index.acquire_lease("fetch:1", "b", 10)
+    index.release_lease("fetch:1", "a")
+    assert index.acquire_lease("fetch:1", "b", 10)
+
+
+def test_expired_lease_is_taken_over(cache_dir):
+    index = server.get_cache_index()
+    assert index.acquire_lease("fetch:1", "a", 0.1)
+    time.sleep(0.2)
+    assert index.acquire_lease("fetch:1", "b", 10)
+
+
+def test_held_lease_is_renewed_past_its_duration(cache_dir, monkeypatch):
+    monkeypatch.setattr(server, "FETCH_LEASE_DURATION", 0.3)
+    monkeypatch.setattr(server, "FETCH_LEASE_RENEW_INTERVAL", 0.1)
+    index = server.get_cache_index()
+    with server.FetchLease("0000320193"):
+        for _ in range(5):
+            time.sleep(0.2)
+            assert not index.acquire_lease("fetch:0000320193", "other", 10)
+    assert index.acquire_lease("fetch:0000320193", "other", 10)
+
+
+def test_waiting_worker_gets_the_lease_on_release(cache_dir):
+    order = []
+
+    def worker(name):
+        with server.FetchLease("0000320193"):
+            order.append(name)
+            time.sleep(0.1)
+            order.append(name)
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in "ab"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert order in (list("aabb"), list("bbaa"))
@@ -0,0 +1,66 @@
+"""process_company_data_incrementally against a full run of the pipeline over the same filings."""
+import copy
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+CIK = "0000320193"
+
+
+def filed_until(data, date):
+    """The payload as it was when the filings up to date (ISO) were out."""
+    data = copy.deepcopy(data)
+    for namespace in data['facts'].values():
+        for concept in namespace.values():
+            for unit, records in concept['units'].items():
+                concept['units'][unit] = [record for record in records if record['filed'] <= date]
+    return data
+
+
+def drop_accns(data, every):
+    """Remove the accession number of every nth record, as some older filings lack one."""
+    for namespace in data['facts'].values():
+        for concept in namespace.values():
+            for records in concept['units'].values():
+                for record in records[::every]:
+                    del record['accn']
+    return data
+
+
+@pytest.fixture
+def payload():
+    return drop_accns(generate_companyfacts(years=8, duplicates=2, missing_quarters=0.2, seed=3), 7)
+
+
+@pytest.mark.parametrize("cutoffs", [[], ["2021-06-30"], ["2019-12-31", "2022-03-31", "2024-11-30"]])
+def test_refreshes_match_a_full_run(payload, cache_dir, cutoffs):
+    for cutoff in cutoffs:
+        server.process_company_data_incrementally(CIK, filed_until(payload, cutoff))
+    assert server.process_company_data_incrementally(CIK, payload) == server.process_company_data(payload)
+
+
+def test_refresh_of_some_label_sets(payload, cache_dir):
+    server.process_company_data_incrementally(CIK, filed_until(payload, "2022-03-31"), ["Revenues"])
+    assert (server.process_company_data_incrementally(CIK, payload, ["Revenues", "NetIncome"]) ==
+            server.process_company_data(payload, ["Revenues", "NetIncome"]))
+
+
+def test_unchanged_filings_are_not_saved_again(payload, cache_dir, monkeypatch):
+    expected = server.process_company_data_incrementally(CIK, payload)
+    saves = []
+    monkeypatch.setattr(server, "save_series", lambda *args: saves.append(args))
+    # Facts without an accession number can't be skipped by extraction, but aren't merged twice
+    assert server.process_company_data_incrementally(CIK, payload) == expected
+    assert saves == []
+
+
+def test_series_round_trip(payload):
+    series = server.LabelSeries(*server.LABELS_SETS["Revenues"])
+    series.update_missing_quarters(series.merge(server.EXTRACTION_PLAN.extract(payload, ["Revenues"])["Revenues"]))
+    assert series.unfiled
+    loaded = server.LabelSeries.from_json(series.to_json())
+    assert loaded.unfiled == series.unfiled
+    assert ([server.fact_to_row(fact) for fact in loaded.completed_facts()] ==
+            [server.fact_to_row(fact) for fact in series.completed_facts()])
@@ -0,0 +1,40 @@
+"""Label sets read from a kpi_mapping.json file."""
+import json
+
+import pytest
+
+import server
+
+
+def write_mapping(tmp_path, label_sets):
+    path = tmp_path / "kpi_mapping.json"
+    path.write_text(json.dumps(label_sets))
+    return str(path)
+
+
+def test_default_without_mapping_file(tmp_path):
+    assert server.load_label_sets(str(tmp_path / "missing.json")) is server.DEFAULT_LABELS_SETS
+
+
+def test_mapping_file_replaces_the_default(tmp_path):
+    label_sets = {name: [labels[:1], unit] for name, (labels, unit) in server.DEFAULT_LABELS_SETS.items()}
+    label_sets['Revenues'] = [["ifrs-full:Revenue", "Revenues"], "USD"]
+    loaded = server.load_label_sets(write_mapping(tmp_path, label_sets))
+    assert loaded['Revenues'] == (["ifrs-full:Revenue", "Revenues"], "USD")
+    assert server.ExtractionPlan(loaded).wanted['ifrs-full'] == {'Revenue': {'USD'}}
+
+
+def test_summed_concepts_are_rejected(tmp_path):
+    label_sets = {name: [labels, unit] for name, (labels, unit) in server.DEFAULT_LABELS_SETS.items()}
+    label_sets['OpEx'] = [[["OperatingExpenses", "CostsAndExpenses"]], "USD"]
+    with pytest.raises(ValueError, match="OpEx"):
+        server.load_label_sets(write_mapping(tmp_path, label_sets))
+    with pytest.raises(ValueError, match="OpEx"):
+        server.ExtractionPlan({'OpEx': ([["OperatingExpenses", "CostsAndExpenses"]], "USD")})
+
+
+def test_label_sets_read_by_derived_metrics_are_required(tmp_path):
+    label_sets = {name: [labels, unit] for name, (labels, unit) in server.DEFAULT_LABELS_SETS.items()
+                  if name not in ('Cost', 'SplitCoef')}
+    with pytest.raises(ValueError, match="Cost, SplitCoef"):
+        server.load_label_sets(write_mapping(tmp_path, label_sets))
@@ -0,0 +1,49 @@
+import pytest
+
+import server
+from benchmark import generate_companyfacts, scan_missing_quarter_data
+
+
+def as_tuples(facts):
+    return [(fact.start, fact.end, fact.val, fact.fp) for fact in facts]
+
+
+def deduplicated_label_sets(data):
+    for labels, unit in server.LABELS_SETS.values():
+        facts = server.parse_facts(server.extract_and_sum_data_from_labels(data, labels, unit))
+        yield server.deduplicate_data(facts)
+
+
+@pytest.mark.parametrize("missing_quarters", [0.0, 0.2, 0.6])
+def test_missing_quarters_match_rescanning_reference(missing_quarters):
+    data = generate_companyfacts(years=40, seed=3, missing_quarters=missing_quarters)
+    for facts in deduplicated_label_sets(data):
+        assert as_tuples(server.add_missing_quarter_data(list(facts))) == as_tuples(scan_missing_quarter_data(list(facts)))
+
+
+def fiscal_year(quarters_known):
+    """A fiscal year of 2023 with its quarters, keeping those whose number is in quarters_known."""
+    start = server.parse_ordinal("2022-10-01")
+    bounds = [("2022-10-01", "2022-12-31"), ("2023-01-01", "2023-03-31"), ("2023-04-01", "2023-06-30"), ("2023-07-01", "2023-09-30")]
+    facts = [server.Fact(start, server.parse_ordinal("2023-09-30"), 100, "a", 2023, "FY")]
+    for number, (quarter_start, quarter_end) in enumerate(bounds, 1):
+        if number in quarters_known:
+            facts.append(server.Fact(server.parse_ordinal(quarter_start), server.parse_ordinal(quarter_end), 10 * number, "a", 2023, f"Q{number}"))
+    return facts
+
+
+@pytest.mark.parametrize("quarters_known, missing", [
+    ({1, 2, 3}, ("2023-07-01", "2023-09-30", 40)),
+    ({1, 3, 4}, ("2023-01-01", "2023-03-31", 20)),
+    ({2, 3, 4}, ("2022-10-01", "2022-12-31", 10)),
+])
+def test_missing_quarter_fills_the_gap(quarters_known, missing):
+    facts = server.add_missing_quarter_data(fiscal_year(quarters_known))
+    inferred = [fact for fact in facts if fact.fp == "QX"]
+    assert [(server.format_ordinal(fact.start), server.format_ordinal(fact.end), fact.val) for fact in inferred] == [missing]
+
+
+@pytest.mark.parametrize("quarters_known", [set(), {1}, {1, 2}, {1, 2, 3, 4}])
+def test_no_quarter_inferred_without_exactly_three_known(quarters_known):
+    facts = server.add_missing_quarter_data(fiscal_year(quarters_known))
+    assert not [fact for fact in facts if fact.fp == "QX"]
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+
+def selected(document, wanted):
+    """What parse_companyfacts should return, computed from the fully decoded document."""
+    expected = {'cik': document['cik'], 'entityName': document['entityName'], 'facts': {}}
+    for namespace, concepts in wanted.items():
+        expected['facts'][namespace] = {
+            concept: {'units': {unit: records for unit, records in document['facts'].get(namespace, {})[concept]['units'].items()
+                                if unit in units}}
+            for concept, units in concepts.items() if concept in document['facts'].get(namespace, {})
+        }
+    return expected
+
+
+@pytest.fixture
+def document():
+    document = generate_companyfacts(years=6, extra_concepts=20, seed=5)
+    facts = document['facts']['us-gaap']
+    # Strings that look like JSON structure around the keys the parse looks for
+    facts['SyntheticConcept00001']['description'] = 'Ends with a backslash \\'
+    facts['SyntheticConcept00002']['description'] = '"Revenues": {"units": {"USD": []}}'
+    facts['SyntheticConcept00003']['description'] = ': {"units": {}}'
+    facts['SyntheticConcept00004']['label'] = 'us-gaap\\": {'
+    facts['Revenues']['description'] = 'Mentions "cik": 1 and "entityName": "Someone else"'
+    return document
+
+
+@pytest.mark.parametrize("dumps", [
+    json.dumps,
+    lambda document: json.dumps(document, indent=2),
+    lambda document: json.dumps(document, separators=(' , ', ' : ')),
+    lambda document: json.dumps({'facts': document['facts'], 'entityName': document['entityName'], 'cik': document['cik']}),
+    lambda document: json.dumps({'timestamp': 1.5, 'data': document}),
+], ids=["compact", "indented", "spaced", "entity-last", "cache-file"])
+def test_selective_parse_matches_full_decode(document, dumps):
+    wanted = server.get_wanted_concepts()
+    assert server.parse_companyfacts(dumps(document)) == selected(document, wanted)
+
+
+def test_parse_reads_other_namespaces(document):
+    document['facts']['ifrs-full'] = {'Revenue': {'label': 'Revenue', 'units': {
+        'USD': [{'start': '2022-01-01', 'end': '2022-12-31', 'val': 5, 'accn': 'a', 'fy': 2022, 'fp': 'FY',
+                 'form': '20-F', 'filed': '2023-03-01'}],
+        'EUR': []}}}
+    wanted = {'ifrs-full': {'Revenue': {'USD'}}, 'us-gaap': {'Revenues': {'USD'}}}
+    assert server.parse_companyfacts(json.dumps(document), wanted) == selected(document, wanted)
+
+
+def test_parse_rejects_non_objects():
+    with pytest.raises(ValueError):
+        server.parse_companyfacts('[1, 2]')
@@ -0,0 +1,47 @@
+import datetime
+import random
+from datetime import timedelta
+
+import pytest
+
+import server
+from benchmark import day_by_day_fiscal_year, day_by_day_quarter
+
+
+def random_periods(count, seed=0):
+    rnd = random.Random(seed)
+    periods = []
+    for _ in range(count):
+        start = datetime.date(1995, 1, 1) + timedelta(days=rnd.randrange(40 * 365))
+        periods.append((start, start + timedelta(days=rnd.choice([0, 1, 27, 89, 90, 91, 92, 181, 363, 364, 365, 370, 729]))))
+    return periods
+
+
+def test_fiscal_year_matches_day_by_day_count():
+    for start, end in random_periods(2000):
+        assert server.get_fiscal_year_from_dates(start, end) == day_by_day_fiscal_year(start, end), (start, end)
+
+
+def test_quarter_matches_day_by_day_count():
+    for start, end in random_periods(2000, seed=1):
+        assert server.get_quarter_from_dates(start, end) == day_by_day_quarter(start, end), (start, end)
+
+
+@pytest.mark.parametrize("start, end, year", [
+    ("2022-09-25", "2023-09-30", 2023),  # 53-week fiscal year
+    ("2019-07-02", "2020-06-30", 2019),  # 366 days, 183 of them in 2019
+    ("2021-07-03", "2022-07-01", 2021),  # 182 days in each year, the earlier wins
+    ("2020-01-01", "2020-12-31", 2020),
+])
+def test_fiscal_year_edge_cases(start, end, year):
+    assert server.get_fiscal_year_from_dates(server.parse_date(start), server.parse_date(end)) == year
+
+
+@pytest.mark.parametrize("start, end, quarter", [
+    ("2023-07-02", "2023-09-30", "Q3"),
+    ("2023-12-31", "2024-03-30", "Q1"),  # quarter straddling the new year
+    ("2023-02-15", "2023-05-16", "Q2"),
+    ("2023-11-16", "2024-02-15", "Q4"),  # 46 days in each quarter, the first reached wins
+])
+def test_quarter_edge_cases(start, end, quarter):
+    assert server.get_quarter_from_dates(server.parse_date(start), server.parse_date(end)) == quarter
@@ -0,0 +1,66 @@
+"""The serialized response cache of company_json_response."""
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+CIK = "0000320193"
+
+
+@pytest.fixture
+def company(cache_dir, monkeypatch):
+    monkeypatch.setattr(server, "ticker_to_cik", lambda ticker: CIK)
+    server.cache_fact_columns(server.cache_path(CIK), generate_companyfacts(years=2))
+    return CIK
+
+
+def respond(compute, **headers):
+    with server.app.test_request_context("/kpis/AAPL?labels=Revenues", headers=headers):
+        return server.company_json_response("AAPL", compute)
+
+
+def test_result_is_cached_and_revalidated(company):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'Revenues': {}}, True
+
+    first = respond(compute)
+    etag, weak = first.get_etag()
+    assert etag and weak
+    assert respond(compute).get_data() == first.get_data()
+    assert respond(compute, **{'If-None-Match': f'W/"{etag}"'}).status_code == 304
+    assert respond(compute, **{'If-None-Match': f'"{etag}"'}).status_code == 304
+    assert len(calls) == 1
+
+
+def test_encodings_share_a_weak_etag(company):
+    compute = lambda: ({'Revenues': {str(year): year * 1000 for year in range(1900, 2100)}}, True)
+    identity = respond(compute)
+    compressed = respond(compute, **{'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert len(compressed.get_data()) < len(identity.get_data())
+    # A strong ETag would claim the two bodies are byte for byte the same
+    assert compressed.get_etag() == identity.get_etag()
+    assert identity.get_etag()[1]
+
+
+def test_result_of_a_refreshed_entry_is_not_cached(company):
+    version = server.get_source_version(company)
+
+    def compute():
+        # A refresh replacing the cache file while the result is computed
+        server.cache_fact_columns(server.cache_path(company), generate_companyfacts(years=2, seed=1))
+        return {'Revenues': {}}, True
+
+    response = respond(compute)
+    assert response.get_etag() == (None, None)
+    assert server.get_source_version(company) != version
+    assert not server._response_cache
+
+
+def test_errors_are_not_cached(company):
+    response = respond(lambda: ({'error': 'Unable to retrieve data for the provided ticker'}, False))
+    assert response.get_etag() == (None, None)
+    assert not server._response_cache
@@ -0,0 +1,40 @@
+"""Cross-sectional screens of the ScreenIndex and the /screen route."""
+import numpy as np
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = server.ScreenIndex(str(tmp_path))
+    for cik, seed in [("0000000001", 1), ("0000000002", 2)]:
+        index.update(cik, server.process_company_data(generate_companyfacts(years=4, seed=seed), ["Revenues"]))
+    # A company without any revenue figures
+    index.update("0000000003", server.process_company_data(generate_companyfacts(years=4), ["NetIncome"]))
+    return index
+
+
+@pytest.mark.parametrize("operator", sorted(server.SCREEN_COMPARISONS))
+def test_filters_leave_out_missing_values(index, operator):
+    threshold = 0 if operator in ('>', '>=', '!=') else 10 ** 15
+    total, page = index.screen([(("Revenues", "2024"), server.SCREEN_COMPARISONS[operator], threshold)])
+    ciks = {cik for cik, _ in page}
+    assert "0000000003" not in ciks
+    assert total == (0 if operator == '=' else 2)
+
+
+def test_sort_leaves_out_missing_values(index):
+    total, page = index.screen(sort=("Revenues", "2024"), descending=False)
+    values = [values[("Revenues", "2024")] for _, values in page]
+    assert total == 2
+    assert values == sorted(values) and not np.isnan(values).any()
+
+
+@pytest.mark.parametrize("query", ["filter=Revenues@2024!=nan", "filter=Revenues@2024>NaN", "filter=Revenues@2024>x",
+                                   "filter=Unknown@2024>0", "sort=Revenues", ""])
+def test_invalid_screens_are_rejected(cache_dir, query):
+    response = server.app.test_client().get(f"/screen?{query}")
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
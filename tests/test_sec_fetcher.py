@@ -0,0 +1,136 @@
+"""SecFetcher against a local stub of the SEC companyfacts endpoint."""
+import gzip
+import json
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import server
+from benchmark import generate_companyfacts
+
+DOCUMENT = json.dumps(generate_companyfacts(cik=320193, years=2)).encode()
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Oct 2025 00:00:00 GMT"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves DOCUMENT gzipped with validators, 304 for a matching If-None-Match, and failures by path."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server
+        with stub.lock:
+            stub.hits.append((time.time(), self.path))
+            failures = stub.failures.get(self.path, 0)
+            if failures:
+                stub.failures[self.path] = failures - 1
+        if failures:
+            self.send_body(503, headers=[("Retry-After", "0")])
+        elif "CIK0000000404" in self.path:
+            self.send_body(404, b"Not found")
+        elif self.headers.get("If-None-Match") == ETAG:
+            self.send_body(304, headers=[("ETag", ETAG)])
+        else:
+            self.send_body(200, gzip.compress(DOCUMENT), [("Content-Encoding", "gzip"), ("ETag", ETAG),
+                                                          ("Last-Modified", LAST_MODIFIED)])
+
+
+@pytest.fixture
+def stub():
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    stub.hits = []
+    stub.failures = {}
+    stub.lock = threading.Lock()
+    stub.url = f"http://127.0.0.1:{stub.server_port}/CIK{{cik}}.json"
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+def make_fetcher(stub, **options):
+    options.setdefault("backoff", 0.01)
+    options.setdefault("rate", 1000)
+    return server.SecFetcher(url=stub.url, timeout=(1, 5), **options)
+
+
+def test_fetch_returns_document_and_validators(stub, cache_dir):
+    fetched = make_fetcher(stub).fetch("0000320193")
+    assert json.loads(fetched.text) == json.loads(DOCUMENT)
+    assert fetched.etag == ETAG
+    assert fetched.last_modified == LAST_MODIFIED
+    assert [path for _, path in stub.hits] == ["/CIK0000320193.json"]
+
+
+def test_conditional_fetch_of_unchanged_document(stub, cache_dir):
+    fetched = make_fetcher(stub).fetch("0000320193", etag=ETAG, last_modified=LAST_MODIFIED)
+    assert fetched == server.FetchedDocument(None, ETAG, LAST_MODIFIED)
+
+
+def test_fetch_retries_server_errors(stub, cache_dir):
+    stub.failures["/CIK0000320193.json"] = 2
+    fetched = make_fetcher(stub, retries=3).fetch("0000320193")
+    assert fetched.text is not None
+    assert len(stub.hits) == 3
+
+
+def test_fetch_gives_up_after_retries(stub, cache_dir):
+    stub.failures["/CIK0000320193.json"] = 10
+    assert make_fetcher(stub, retries=2).fetch("0000320193") is None
+    assert len(stub.hits) == 3
+
+
+def test_fetch_does_not_retry_client_errors(stub, cache_dir):
+    assert make_fetcher(stub).fetch("0000000404") is None
+    assert len(stub.hits) == 1
+
+
+def fetch_from_worker(url, cache_dir, count, rate):
+    server.CACHE_DIR = cache_dir
+    fetcher = server.SecFetcher(url=url, rate=rate, timeout=(1, 5))
+    for _ in range(count):
+        fetcher.fetch("0000320193", etag=ETAG)
+
+
+def test_rate_limit_is_shared_between_processes(stub, cache_dir):
+    processes, count, rate = 3, 8, 20
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=fetch_from_worker, args=(stub.url, cache_dir, count, rate))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+
+    times = sorted(hit for hit, _ in stub.hits)
+    assert len(times) == processes * count
+    # Separate limiters would let all of them through in a third of the time
+    assert times[-1] - times[0] >= 0.9 * (len(times) - 1) / rate
+    for first, last in zip(times, times[rate:]):
+        assert last - first >= 0.9
+
+
+def test_unshared_rate_limit(stub, cache_dir):
+    fetcher = make_fetcher(stub, rate=20, shared_limit=False)
+    assert isinstance(fetcher.limiter, server.TokenBucket)
+    started = time.time()
+    for _ in range(5):
+        fetcher.fetch("0000320193", etag=ETAG)
+    assert time.time() - started >= 0.9 * 4 / 20